@@ -1,4 +1,5 @@
 import configparser
+import os
 import sys
 
 import aiomysql
@@ -72,6 +73,75 @@ try:
     embed_color: int = int(config.get("discord", "embed_color"), base=16)
     embed_url: str = config.get("discord", "embed_url")
 
+    # Getting the variables from `[database]`
+    db_pool_minsize: int = config.getint("database", "pool_minsize", fallback=5)
+    db_pool_maxsize: int = config.getint("database", "pool_maxsize", fallback=20)
+    migration_concurrency: int = config.getint("database", "migration_concurrency", fallback=2)
+    migration_pause: float = config.getfloat("database", "migration_pause", fallback=1.0)
+    db_local_infile: bool = config.getboolean("database", "local_infile", fallback=False)
+    db_read_replica: bool = config.getboolean("database", "read_replica", fallback=False)
+    db_read_max_staleness: float = config.getfloat("database", "read_max_staleness", fallback=30.0)
+    db_partition_tables: bool = config.getboolean("database", "partition_tables", fallback=False)
+    db_partition_months_ahead: int = config.getint("database", "partition_months_ahead", fallback=3)
+
+    # Getting the variables from `[sharding]`, every backend's credentials are in `[secret]` like db1's
+    shard_backends = [i.strip() for i in config.get("sharding", "backends", fallback="").split(",") if i.strip()]
+    shard_refresh: float = config.getfloat("sharding", "refresh", fallback=5.0)
+    shard_move_chunk_size: int = config.getint("sharding", "move_chunk_size", fallback=10000)
+    shard_creds = {
+        name: {
+            'host': config.get("secret", f"{name}_host"), 'port': config.getint("secret", f"{name}_port"),
+            'user': config.get("secret", f"{name}_user"), 'password': config.get("secret", f"{name}_password"),
+            'db': config.get("secret", f"{name}_name"),
+        }
+        for name in shard_backends
+    }
+
+    # Getting the variables from `[render]`
+    render_workers: int = config.getint("render", "workers", fallback=2)
+    render_max_concurrent: int = config.getint("render", "max_concurrent", fallback=4)
+
+    # Getting the variables from `[ingest]`
+    ingest_batch_size: int = config.getint("ingest", "batch_size", fallback=500)
+    ingest_max_delay: float = config.getfloat("ingest", "max_delay", fallback=2.0)
+    ingest_max_pending: int = config.getint("ingest", "max_pending", fallback=20000)
+    ingest_spool_dir: str = config.get("ingest", "spool_dir", fallback="./data/spool")
+    ingest_spool_segment_size: int = config.getint("ingest", "spool_segment_size", fallback=64 * 1024 * 1024)
+    ingest_spool_max_records: int = config.getint("ingest", "spool_max_records", fallback=1000000)
+
+    # Getting the variables from `[replication]`
+    replication_enabled: bool = config.getboolean("replication", "enabled", fallback=False)
+    replication_spool_dir: str = config.get("replication", "spool_dir", fallback="./data/replication")
+    replication_pool_maxsize: int = config.getint("replication", "pool_maxsize", fallback=5)
+    replication_heartbeat_interval: float = config.getfloat("replication", "heartbeat_interval", fallback=10.0)
+
+    # Getting the variables from `[deletion]`
+    deletion_chunk_size: int = config.getint("deletion", "chunk_size", fallback=5000)
+    deletion_pause: float = config.getfloat("deletion", "pause", fallback=0.5)
+    deletion_poll_interval: float = config.getfloat("deletion", "poll_interval", fallback=10.0)
+
+    # Getting the variables from `[archive]`
+    archive_enabled: bool = config.getboolean("archive", "enabled", fallback=False)
+    archive_age_days: int = config.getint("archive", "age_days", fallback=365)
+    archive_chunk_size: int = config.getint("archive", "chunk_size", fallback=10000)
+    archive_pause: float = config.getfloat("archive", "pause", fallback=0.5)
+
+    # Getting the variables from `[listener]`
+    heartbeat_interval: float = config.getfloat("listener", "heartbeat_interval", fallback=30.0)
+    gap_recovery_concurrency: int = config.getint("listener", "gap_recovery_concurrency", fallback=4)
+    listener_workers: int = config.getint("listener", "workers", fallback=1)
+    listener_shard_count: int = config.getint("listener", "shard_count", fallback=0) or listener_workers
+
+    # Getting the variables from `[metrics]`
+    metrics_enabled: bool = config.getboolean("metrics", "enabled", fallback=False)
+    metrics_host: str = config.get("metrics", "host", fallback="127.0.0.1")
+    metrics_port: int = config.getint("metrics", "port", fallback=9464)
+
+    # Getting the variables from `[harvest]`
+    harvest_concurrency: int = config.getint("harvest", "concurrency", fallback=8)
+    harvest_progress_interval: float = config.getfloat("harvest", "progress_interval", fallback=10.0)
+    harvest_chunk_size: int = config.getint("harvest", "chunk_size", fallback=10000)
+
 
 except Exception as err:
     log.critical("Error getting variables from the config file. Error: " + str(err))
@@ -84,8 +154,23 @@ else:
     log.setLevel("INFO")
     log.warning(f"Invalid log level `{log_level.upper().strip()}`. Defaulting to INFO.")
 
+# The index of this listener worker process, set by the supervisor in bot.py when there are several
+listener_worker = os.environ.get("LISTENER_WORKER")
+listener_worker = int(listener_worker) if listener_worker is not None else None
+
+# Names the listener processes go by in heartbeats, listener gaps and spool directories
+listener_names = ["listener"] if listener_workers == 1 else [f"listener-{i}" for i in range(listener_workers)]
+listener_name = listener_names[listener_worker or 0]
+
 # Initializing the client
-client = commands.Bot(intents=intents, command_prefix="!")  # Setting prefix
+if listener_worker is not None:
+    # a worker only connects the gateway shards it owns
+    client = commands.AutoShardedBot(
+        intents=intents, command_prefix="!", shard_count=listener_shard_count,
+        shard_ids=[i for i in range(listener_shard_count) if i % listener_workers == listener_worker],
+    )
+else:
+    client = commands.Bot(intents=intents, command_prefix="!")  # Setting prefix
 
 _embed_template = discord.Embed(title="Error!", color=embed_color, url=embed_url)
 _embed_template.set_footer(text=embed_footer)
@@ -1,7 +1,17 @@
 import asyncio
 import os
+import signal
 import sys
-from backend import client, discord_token, log, presence, mode
+import time
+from backend import (
+    client, discord_token, log, presence, mode, get_db_creds, db_pool_minsize, db_pool_maxsize, render_workers,
+    render_max_concurrent, db_local_infile, replication_enabled, replication_spool_dir, replication_pool_maxsize,
+    replication_heartbeat_interval, ingest_batch_size, ingest_spool_segment_size, db_read_replica,
+    db_read_max_staleness, db_partition_tables, db_partition_months_ahead, shard_creds, shard_refresh,
+    listener_workers, listener_worker, listener_shard_count, listener_names, listener_name, metrics_enabled,
+    metrics_host, metrics_port,
+)
+from srg_analytics import DB, Replicator, Spool, renderer, start_metrics_server
 import discord.utils
 
 
@@ -24,15 +34,124 @@ async def load_cogs(mode):
         await client.load_extension(f"cogs.Listeners")
 
 
-asyncio.run(load_cogs(mode))
+async def main():
+    # One connection pool for the whole process, shared by every cog through `client.db`
+    client.db = DB(
+        db_creds=get_db_creds('onsite'), minsize=db_pool_minsize, maxsize=db_pool_maxsize,
+        local_infile=db_local_infile,
+        read_creds=get_db_creds('offsite') if db_read_replica else None, read_max_staleness=db_read_max_staleness,
+        read_heartbeats=[f"replication:{i}" for i in listener_names],
+        partition_tables=db_partition_tables, partition_months_ahead=db_partition_months_ahead,
+        name="db1", shards=shard_creds, shard_refresh=shard_refresh,
+    )
+    await client.db.connect()
 
+    # Writes are replayed onto the offsite database in the background, each process with its own spool
+    if replication_enabled:
+        name = listener_name if mode == "listener" else mode
 
-# Run the actual bot
-try:
-    client.run(discord_token)
-except discord.LoginFailure:
-    log.critical("Invalid Discord Token. Please check your config file.")
-    sys.exit()
-except Exception as err:
-    log.critical(f"Error while connecting to Discord. Error: {err}")
-    sys.exit()
+        client.db.replicator = Replicator(
+            DB(db_creds=get_db_creds('offsite'), minsize=1, maxsize=replication_pool_maxsize, name="db2"),
+            Spool(os.path.join(replication_spool_dir, name), segment_size=ingest_spool_segment_size),
+            name=name, batch_size=ingest_batch_size, heartbeat_interval=replication_heartbeat_interval,
+        )
+        client.db.replicator.start()
+
+    # The listener never draws charts, so it doesn't need the render workers
+    if mode != "listener":
+        renderer.start(workers=render_workers, max_concurrent=render_max_concurrent)
+
+    # Every process serves its own metrics, on a port of its own
+    metrics_server = None
+    if metrics_enabled:
+        port = metrics_port if mode != "listener" else metrics_port + 1 + (listener_worker or 0)
+        metrics_server = await start_metrics_server(metrics_host, port)
+
+    try:
+        async with client:
+            await load_cogs(mode)
+            await client.start(discord_token)
+    finally:
+        # the cogs are unloaded when the client closes, so the pool is closed after they are done with it
+        if client.db.replicator is not None:
+            await client.db.replicator.close()
+
+        await client.db.close()
+        renderer.shutdown()
+
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+async def run_worker(worker: int):
+    """Runs a listener worker process, restarting it whenever it exits."""
+    failures = 0
+
+    while True:
+        started = time.monotonic()
+        # in a session of its own, so ctrl+c only reaches it through the supervisor, once
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env={**os.environ, "LISTENER_WORKER": str(worker)},
+            start_new_session=True,
+        )
+        log.info(f"Supervisor: started listener worker {worker} (pid {process.pid})")
+
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            # the same as ctrl+c, so the worker writes out what it has buffered
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                process.kill()
+            raise
+
+        # a worker that keeps failing right after starting is restarted less and less often
+        failures = failures + 1 if time.monotonic() - started < 60 else 1
+        delay = min(2 ** failures, 60)
+
+        log.error(f"Supervisor: listener worker {worker} exited with code {code}, restarting in {delay}s")
+        await asyncio.sleep(delay)
+
+
+async def supervise():
+    """Runs the listener as `listener_workers` processes, each connecting some of the gateway shards."""
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    workers = []
+
+    try:
+        for i in range(listener_workers):
+            workers.append(asyncio.create_task(run_worker(i)))
+
+            # shards can only identify one every 5 seconds, so the workers connect one after the other
+            await asyncio.sleep(5 * -(-listener_shard_count // listener_workers))
+
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+# Run the actual bot. The guard keeps the render worker processes from starting a bot of their own
+if __name__ == "__main__":
+    if mode == "listener" and listener_workers > 1 and listener_worker is None:
+        try:
+            asyncio.run(supervise())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        sys.exit()
+
+    try:
+        asyncio.run(main())
+    except discord.LoginFailure:
+        log.critical("Invalid Discord Token. Please check your config file.")
+        sys.exit()
+    except KeyboardInterrupt:
+        pass
+    except Exception as err:
+        log.critical(f"Error while connecting to Discord. Error: {err}")
+        sys.exit()
@@ -1,13 +1,13 @@
 import datetime
 import discord
 from discord.ext import commands
-from backend import log, embed_template, error_template, get_db_creds
+from backend import log, embed_template, error_template
 from discord import app_commands
 from srg_analytics import (
-    DB,
     get_top_users_visual,
     get_top_users,
-    activity_server, activity_user
+    activity_server, activity_user,
+    resolver,
 )
 import os
 
@@ -81,8 +81,7 @@ class Activity(commands.GroupCog, name="activity"):
     async def activity_server(self, interaction, timeperiod: app_commands.Choice[str]):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         timezone = await db.get_timezone(guild_id=interaction.guild.id)
         if not timezone:
@@ -120,6 +119,7 @@ class Activity(commands.GroupCog, name="activity"):
                 return
 
         e = await activity_server(
+            db=db,
             server_id=interaction.guild.id,
             start_date=start_date,
             end_date=end_date,
@@ -151,8 +151,7 @@ class Activity(commands.GroupCog, name="activity"):
     ):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         timezone = await db.get_timezone(guild_id=interaction.guild.id)
         if not timezone:
@@ -193,6 +192,7 @@ class Activity(commands.GroupCog, name="activity"):
         user_nicknames = [user.display_name for user in [user_1, user_2, user_3, user_4, user_5] if user is not None][:len(user_ids)]
 
         e = await activity_user(
+            db=db,
             server_id=interaction.guild.id,
             user_ids=user_ids,
             user_nicknames=user_nicknames,
@@ -225,8 +225,7 @@ class Activity(commands.GroupCog, name="activity"):
     ):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         # get top users today
         top = await get_top_users(
@@ -242,18 +241,10 @@ class Activity(commands.GroupCog, name="activity"):
 
         top = [i[0] for i in top]
 
-        user_list = []
+        # get every nickname at once, skipping members that can't be found
+        names = await resolver.member_names(interaction.guild, top)
 
-        for user in top:
-            # get user object
-            user = await interaction.guild.fetch_member(user)
-
-            if user is None:
-                continue
-
-            nick = user.nick if hasattr(user, 'nick') else user.display_name or user.name
-
-            user_list.append((nick, user.id))
+        user_list = [(names[user], user) for user in top if names[user] is not None]
 
         # file = await activity_user_visual(
         #     db=db,
@@ -277,8 +268,7 @@ class Activity(commands.GroupCog, name="activity"):
     async def activity_serverpast(self, interaction, start_date: str, end_date: str):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         # Timezone logic
         timezone = await db.get_timezone(guild_id=interaction.guild.id)
@@ -330,8 +320,7 @@ class Activity(commands.GroupCog, name="activity"):
     ):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         timezone = await db.get_timezone(guild_id=interaction.guild.id)
         if not timezone:
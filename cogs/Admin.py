@@ -1,14 +1,12 @@
 import asyncio
-import time
 import discord
 from discord.ext import commands
-from backend import log, db1_creds, db2_creds, is_admin, ConfirmButton, get_db_creds
+from backend import log, is_admin, ConfirmButton, harvest_concurrency, harvest_progress_interval, harvest_chunk_size
 from discord import app_commands, TextChannel, Member, User
 from backend import embed_template, error_template  # , remove_ignore_autocomplete
 import warnings
-import threading
 
-from srg_analytics import DB
+from srg_analytics import Harvest, harvest_targets, save_history
 
 warnings.filterwarnings("ignore", module=r"aiomysql")
 
@@ -22,29 +20,46 @@ class Admin(commands.Cog, name="admin"):
         log.info("Cog: Admin.py Loaded")
         # await self.client.tree.sync()
 
-    async def save_channel(self, channel):
+    async def save_channel(self, channel, harvest: Harvest = None, limit: int = None):
+        """Harvests what's missing of a channel: the messages since the last harvest, then, if the history wasn't
+        read back to the start yet, older messages from where the last harvest stopped.
+
+        Progress is saved after every chunk, so an interrupted harvest picks up where it stopped. The messages since
+        the last harvest are few and keep the rollups up to date. The older ones are bulk loaded, which doesn't, and
+        `guild_harvest` rebuilds the rollups once every channel is done.
+        """
         guild_id = channel.guild.id
+        db = self.client.db
+
+        newest, oldest, complete = await db.get_harvest_progress(guild_id, channel.id) or (None, None, False)
+
+        async def checkpoint(rows):
+            nonlocal newest, oldest
+
+            ids = [row[0] for row in rows]
+            newest = max(ids) if newest is None else max(newest, *ids)
+            oldest = min(ids) if oldest is None else min(oldest, *ids)
+
+            await db.set_harvest_progress(guild_id, channel.id, newest, oldest, complete)
+
+            if harvest is not None:
+                harvest.messages += len(rows)
+
+        if newest is not None:
+            await save_history(
+                db, channel, harvest_chunk_size, checkpoint, bulk=False,
+                limit=None, after=discord.Object(newest), oldest_first=True,
+            )
 
-        message_ids = []
-        channel_ids = []
-        author_ids = []
-        aliased_author_ids = []
-        message_lengths = []
-        epoches = []
-        has_embeds = []
-        num_attachments = []
-
-        async for message in channel.history(limit=None):
-            message_ids.append(message.id)
-            channel_ids.append(message.channel.id)
-            author_ids.append(message.author.id)
-            message_lengths.append(len(message.content))
-            epoches.append(message.created_at.timestamp())
-            has_embeds.append(message.embeds != [])
-            num_attachments.append(len(message.attachments))
-
-        db = DB(get_db_creds('onsite'))
-        await db.add_messages_bulk(guild_id, message_ids, channel_ids, author_ids, aliased_author_ids, message_lengths, epoches, has_embeds, num_attachments)
+        if not complete:
+            read = await save_history(
+                db, channel, harvest_chunk_size, checkpoint,
+                limit=limit, before=discord.Object(oldest) if oldest is not None else None,
+            )
+
+            # with a limit, the history was only read back to the start if it ran out first
+            complete = limit is None or read < limit
+            await db.set_harvest_progress(guild_id, channel.id, newest, oldest, complete)
 
     @app_commands.command()
     @app_commands.allowed_installs(guilds=True, users=False)
@@ -54,33 +69,58 @@ class Admin(commands.Cog, name="admin"):
             interaction,
             channel: discord.TextChannel | discord.ForumChannel = None,
             amount: int = None,
+            full: bool = False,
     ):
-        start_time = time.time()
-        guild = interaction.guild
+        await interaction.response.defer()
+
+        if full:
+            # read every channel from the start again, e.g. after messages were lost from the database
+            await self.client.db.clear_harvest_progress(interaction.guild.id)
+
+        # creates the guild's table if the bot joined while the listener was offline
+        await self.client.db.add_guild(interaction.guild.id)
+
+        harvest = Harvest(
+            lambda target, h: self.save_channel(target, h, limit=amount), concurrency=harvest_concurrency
+        )
+        task = asyncio.create_task(
+            harvest.run(harvest_targets([channel] if channel is not None else interaction.guild.channels))
+        )
+
+        # the interaction can only be edited for 15 minutes, after that progress goes to a message in the channel
+        status = None
+
+        async def report():
+            nonlocal status
 
-        for channel in guild.channels:
-            # guild.channel superclasses:
-            # TextChannel, VoiceChannel, CategoryChannel, StageChannel, ForumChannel
-            print(channel)
+            embed = embed_template()
+            embed.title = "Harvest finished" if task.done() else "Harvesting..."
+            embed.description = harvest.summary()
 
-            if isinstance(channel, discord.TextChannel):
-                await self.save_channel(channel)
+            if status is None:
+                try:
+                    await interaction.edit_original_response(embed=embed)
+                    return
+                except discord.HTTPException:
+                    status = await interaction.channel.send(embed=embed)
+                    return
 
-                for thread in channel.threads:
-                    await self.save_channel(thread)
+            await status.edit(embed=embed)
 
-                async for thread in channel.archived_threads():
-                    await self.save_channel(thread)
+        while not task.done():
+            await asyncio.wait([task], timeout=harvest_progress_interval)
 
-            elif isinstance(channel, discord.ForumChannel):
-                for thread in channel.threads:
-                    await self.save_channel(thread)
+            try:
+                await report()
+            except discord.HTTPException as e:
+                log.warning(f"Harvest: couldn't report progress: {e}")
 
-                async for thread in channel.archived_threads():
-                    await self.save_channel(thread)
+        # rebuilt even if the harvest failed part way, the rows loaded until then are kept
+        if not await self.client.db.rollups_ready(interaction.guild.id):
+            await self.client.db.rebuild_rollups(interaction.guild.id)
 
-            elif isinstance(channel, discord.VoiceChannel):
-                await self.save_channel(channel)
+        # re-raises anything that stopped the harvest itself
+        task.result()
 
     @commands.Cog.listener()
     async def check(self, ctx):
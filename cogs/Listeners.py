@@ -1,30 +1,167 @@
+import asyncio
+import os
+import time
+
 from discord.ext import commands, tasks
-from backend import log, get_db_creds
-from srg_analytics import DB
+from backend import log, ingest_batch_size, ingest_max_delay, ingest_max_pending, heartbeat_interval, \
+    gap_recovery_concurrency, ingest_spool_dir, ingest_spool_segment_size, ingest_spool_max_records, \
+    deletion_chunk_size, deletion_pause, deletion_poll_interval, archive_enabled, archive_age_days, archive_chunk_size, \
+    archive_pause, listener_name, listener_worker
+from srg_analytics import DeletionWorker, IngestQueue, Spool, archive_all, backfill_gap, maintain_partitions, \
+    message_row
 
 
 class Listeners(commands.Cog):
     def __init__(self, client):
-        self.db = DB(db_creds=get_db_creds('onsite'))  # TODO change to offsite
         self.client = client
+        # writes reach the offsite database through `self.db.replicator`, see bot.py
+        self.db = client.db
+
+        # every worker process has a spool of its own
+        spool_dir = os.path.join(ingest_spool_dir, listener_name) if listener_worker is not None else ingest_spool_dir
+
+        self.ingest = IngestQueue(
+            self.db, batch_size=ingest_batch_size, max_delay=ingest_max_delay, max_pending=ingest_max_pending,
+            spool=Spool(spool_dir, segment_size=ingest_spool_segment_size) if ingest_spool_dir else None,
+            max_spooled=ingest_spool_max_records,
+        )
+
+        # large deletions queued by the handlers below, and by /owners commands from the bot process
+        self.deletions = DeletionWorker(
+            self.db, chunk_size=deletion_chunk_size, pause=deletion_pause, poll_interval=deletion_poll_interval
+        )
 
         self.channel_ignores = {}
         self.user_ignores = {}
         self.aliased_users = {}
 
+        self._disconnected_at = None
+        self._recovery = None
+
     @commands.Cog.listener()
     async def on_ready(self):
         log.info("Cog: Listeners.py Loaded")
-        await self.db.connect()
+
+        now = time.time()
+        # messages still buffered when the listener stopped were lost too
+        margin = heartbeat_interval + ingest_max_delay
+
+        if not self.heartbeat.is_running():
+            # a fresh start, the events since the process stopped aren't replayed however short the restart was
+            last_seen = await self.db.get_heartbeat(listener_name)
+            if last_seen is not None:
+                log.warning(f"Listeners: the listener was down for {int(now - last_seen)}s")
+                await self.db.add_listener_gap(last_seen - margin, now, listener_name)
+
+            self.heartbeat.start()
+
+        elif self._disconnected_at is not None:
+            # a new gateway session, the events since the disconnect won't be replayed
+            log.warning(f"Listeners: the gateway was disconnected for {int(now - self._disconnected_at)}s")
+            await self.db.add_listener_gap(self._disconnected_at - margin, now, listener_name)
+
+        self._disconnected_at = None
+
+        if self._recovery is None or self._recovery.done():
+            self._recovery = asyncio.create_task(self.recover_gaps())
+
+    @commands.Cog.listener()
+    async def on_disconnect(self):
+        if self._disconnected_at is None:
+            self._disconnected_at = time.time()
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        # the session was resumed, so discord replays every event that was missed
+        self._disconnected_at = None
+
+    async def cog_load(self):
+        self.ingest.start()
+
+        # the jobs that aren't about the guilds of this process' shards only run in the first one
+        if not listener_worker:
+            self.deletions.start()
+            self.partition_maintenance.start()
+
+            if archive_enabled:
+                self.archive.start()
+
+    async def cog_unload(self):
+        self.heartbeat.cancel()
+        self.partition_maintenance.cancel()
+        self.archive.cancel()
+        await self.deletions.close()
+
+        if self._recovery is not None:
+            self._recovery.cancel()
+
+        # write out whatever is still buffered before shutting down
+        await self.ingest.close()
+
+    @tasks.loop(seconds=heartbeat_interval)
+    async def heartbeat(self):
+        try:
+            await self.db.set_heartbeat(listener_name)
+        except Exception as e:
+            log.error(f"Listeners: couldn't write the heartbeat: {e}")
+
+    @tasks.loop(hours=24)
+    async def partition_maintenance(self):
+        # new months are split off the empty last partition, which is instant
+        try:
+            await maintain_partitions(self.db, self.db.partition_months_ahead)
+        except Exception as e:
+            log.error(f"Listeners: partition maintenance failed: {e}")
+
+    @tasks.loop(hours=24)
+    async def archive(self):
+        try:
+            await archive_all(self.db, archive_age_days, chunk_size=archive_chunk_size, pause=archive_pause)
+        except Exception as e:
+            log.error(f"Listeners: archiving failed: {e}")
+
+    async def recover_gaps(self):
+        """Backfills the windows in which messages were missed, only reading channels active since then."""
+        try:
+            guild_ids = set(await self.db.get_guild_ids())
+
+            for start, end in await self.db.get_listener_gaps(listener_name):
+                messages = 0
+                failed = 0
+
+                for guild in self.client.guilds:
+                    if guild.id not in guild_ids:
+                        continue
+
+                    res = await backfill_gap(
+                        self.db, guild, start, end, concurrency=gap_recovery_concurrency, chunk_size=ingest_batch_size
+                    )
+                    messages += res.messages
+                    failed += len(res.failed)
+
+                # windows with failed channels are tried again on the next start
+                if not failed:
+                    await self.db.remove_listener_gap(start, end, listener_name)
+
+                log.info(
+                    f"Listeners: backfilled {messages} messages missed in a {int(end - start)}s gap, "
+                    f"{failed} channels failed"
+                )
+
+        except Exception as e:
+            log.error(f"Listeners: gap recovery failed: {e}")
 
     @commands.Cog.listener()
     async def on_message_edit(self, before, after):
         if self.db.con is None:
+            log.warning("Listeners: self.db is None, connecting")
             await self.db.connect()
-            return log.warning("Listeners: self.db is None")
 
         has_embed = after.embeds != []
 
+        # the message may still be buffered, it has to be written before it can be edited
+        await self.ingest.flush(before.guild.id, before.id)
+
         await self.db.edit_message(
             guild_id=before.guild.id, message_id=before.id, message_length=len(after.content),
             num_attachments=len(after.attachments), has_embed=has_embed
@@ -35,8 +172,14 @@ class Listeners(commands.Cog):
         log.info(f"Joined guild {guild.id}")
 
         if self.db.con is None:
+            log.warning("Listeners: self.db is None, connecting")
             await self.db.connect()
-            return log.warning("Listeners: self.db is None")
+
+        # rejoined before the guild's data was deleted, keep what's left of it. The deleted part is read again by
+        # the next harvest
+        if any(job[1] == "guild" and job[2] == guild.id for job in await self.db.get_deletion_jobs()):
+            await self.db.cancel_deletions(guild.id, "guild")
+            await self.db.clear_harvest_progress(guild.id)
 
         await self.db.add_guild(guild.id)
 
@@ -45,18 +188,22 @@ class Listeners(commands.Cog):
         log.info(f"Removed from guild {guild.id}")
 
         if self.db.con is None:
+            log.warning("Listeners: self.db is None, connecting")
             await self.db.connect()
-            return log.warning("Listeners: self.db is None")
 
         # When the bot is removed from a guild, delete all data associated with that guild
-        await self.db.remove_guild(guild.id)
+        await self.db.queue_deletion("guild", guild.id)
+        self.deletions.wake()
         await self.db.execute(f"DELETE FROM `config` WHERE `data1` = {guild.id}")
 
     @commands.Cog.listener()
     async def on_message_delete(self, message):
         if self.db.con is None:
+            log.warning("Listeners: self.db is None, connecting")
             await self.db.connect()
-            return log.warning("Listeners: self.db is None")
+
+        # otherwise a buffered message would be written after its deletion, and never removed
+        await self.ingest.flush(message.guild.id, message.id)
 
         await self.db.delete_message(guild_id=message.guild.id, message_id=message.id)
 
@@ -65,8 +212,9 @@ class Listeners(commands.Cog):
         channel_id = channel.id
         guild_id = channel.guild.id
 
-        # delete all messages in that channel from database
-        await self.db.execute(f"DELETE FROM `{guild_id}` WHERE `channel_id` = {channel_id}")
+        # delete all messages in that channel from database, in the background
+        await self.db.queue_deletion("channel", guild_id, channel_id)
+        self.deletions.wake()
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -103,20 +251,9 @@ class Listeners(commands.Cog):
         except KeyError:
             pass
 
-        msg = {
-            'message_id': message.id,
-            'channel_id': message.channel.id,
-            'author_id': message.author.id,
-            'aliased_author_id': author_id,
-            'message_length': len(message.content),
-            'epoch': message.created_at.timestamp(),
-            'has_embed': message.embeds != [],
-            'num_attachments': len(message.attachments),
-        }
-
         try:
-            await self.db.add_message(guild_id=message.guild.id, data=msg)
-            log.debug(f"Added message: {msg['message_id']}")
+            await self.ingest.put(guild_id, message_row(message, author_id))
+            log.debug(f"Queued message: {message.id} ({self.ingest.depth} buffered)")
 
         except Exception as e:
             log.error(f"Error while adding message: {e}")
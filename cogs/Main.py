@@ -1,11 +1,9 @@
-import os
+import io
 import discord
 import time
 from discord.ext import commands
 from discord import app_commands
-from backend import get_db_creds
 from srg_analytics import (
-    DB,
     get_top_users_visual,
     get_top_channels_visual,
     build_profile,
@@ -61,8 +59,7 @@ class Main(commands.Cog):
     ):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         # if amount isn't in the range 1-20, set it to 10
         if not 1 <= amount < 21:
@@ -94,19 +91,16 @@ class Main(commands.Cog):
 
         embed.set_image(url="attachment://image.png")
 
-        # open res as a file and send it
+        # res is the PNG itself, sent straight from memory
         await interaction.followup.send(
-            embed=embed, file=discord.File(res, filename="image.png")
+            embed=embed, file=discord.File(io.BytesIO(res), filename="image.png")
         )
 
-        os.remove(res)
-
     @app_commands.command()
     async def profile(self, interaction, member: discord.Member = None):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         if not member:
             member = interaction.user
@@ -119,21 +113,21 @@ class Main(commands.Cog):
         # Create embed
         embed = embed_template()
         embed.title = f"Profile for {member}"
-        embed.description = f"Here is the profile for {member.mention}. Took {round(profile['time_taken'], 2)} seconds to generate."
+        embed.description = f"Here is the profile for {member.mention}. Took {round(profile.time_taken, 2)} seconds to generate."
 
-        embed.add_field(name="Messages", value=profile['messages'], inline=False)
-        embed.add_field(name="Characters", value=profile['characters'], inline=False)
+        embed.add_field(name="Messages", value=profile.messages, inline=False)
+        embed.add_field(name="Characters", value=profile.characters, inline=False)
         embed.add_field(
             name="Average Message Length",
-            value=f"{round(profile['average_message_length'], 2)} Characters",
+            value=f"{round(profile.average_message_length, 2)} Characters",
             inline=False,
         )
         embed.add_field(
-            name="Total Attachments", value=profile['total_attachments'], inline=False
+            name="Total Attachments", value=profile.total_attachments, inline=False
         )
         if member.bot:
             embed.add_field(
-                name="Total Embeds", value=profile['total_embeds'], inline=False
+                name="Total Embeds", value=profile.total_embeds, inline=False
             )
 
         await interaction.followup.send(embed=embed)
@@ -142,8 +136,7 @@ class Main(commands.Cog):
     async def topdate(self, interaction, member: discord.Member = None):
         await interaction.response.defer()
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         if member:
             res = await get_user_top_date(db, interaction.guild.id, member.id)
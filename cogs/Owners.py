@@ -1,13 +1,19 @@
+import asyncio
+
 from discord.ext import commands
 from discord import app_commands
-from srg_analytics import DB
 from backend import (
     log,
     embed_template,
     error_template,
     owner_ids,
-    owner_guilds, get_db_creds,
+    owner_guilds,
+    migration_concurrency,
+    migration_pause,
+    shard_move_chunk_size,
 )
+from srg_analytics import migrate_all, chart_cache, query_cache, resolver, get_partitions, partition_table, \
+    get_shard_counts, move_guild
 
 
 
@@ -79,8 +85,7 @@ class Owners(
         if interation.user.id not in owner_ids:
             return
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
 
         await db.add_guild(guild_id)
 
@@ -93,15 +98,160 @@ class Owners(
         if interation.user.id not in owner_ids:
             return
 
-        db = DB(db_creds=get_db_creds('onsite'))
-        await db.connect()
+        db = self.client.db
+
+        # deleted in the background by the listener
+        await db.queue_deletion("guild", int(guild_id))
+
+        await interation.response.send_message(
+            f"Queued the removal of guild {guild_id}", ephemeral=True
+        )
+
+    @app_commands.command()
+    async def purge_user(self, interation, guild_id: str, user_id: str):
+        """Deletes every message of a user in a guild."""
+        if interation.user.id not in owner_ids:
+            return
 
-        await db.remove_guild(guild_id)
+        await self.client.db.queue_deletion("author", int(guild_id), int(user_id))
 
         await interation.response.send_message(
-            f"Removed guild {guild_id}", ephemeral=True
+            f"Queued the deletion of {user_id}'s messages in guild {guild_id}", ephemeral=True
+        )
+
+    @app_commands.command()
+    async def deletions(self, interation):
+        """Shows the deletions that are queued or running."""
+        if interation.user.id not in owner_ids:
+            return
+
+        jobs = await self.client.db.get_deletion_jobs()
+
+        embed = embed_template()
+        embed.title = "Deletions"
+        embed.description = "\n".join(
+            f"{job_id}: {kind} {target_id or ''} of {guild_id}, {status}, {deleted} messages deleted"
+            for job_id, kind, guild_id, target_id, status, deleted, _ in jobs[:25]
+        ) or "Nothing queued"
+
+        await interation.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command()
+    async def rebuild_rollups(self, interation, guild_id: str = None):
+        """Rebuilds the hourly rollups of a guild, or of every guild, from its stored messages."""
+        if interation.user.id not in owner_ids:
+            return
+
+        await interation.response.defer(ephemeral=True)
+
+        db = self.client.db
+        guild_ids = [int(guild_id)] if guild_id else await db.get_guild_ids()
+
+        for i in guild_ids:
+            await db.rebuild_rollups(i)
+            log.info(f"Rebuilt rollups for guild {i}")
+
+        await interation.followup.send(
+            f"Rebuilt the rollups of {len(guild_ids)} guild(s)", ephemeral=True
+        )
+
+    @app_commands.command()
+    async def migrate(self, interation):
+        """Brings every guild table up to the current schema."""
+        if interation.user.id not in owner_ids:
+            return
+
+        await interation.response.defer(ephemeral=True)
+
+        res = await migrate_all(self.client.db, concurrency=migration_concurrency, pause=migration_pause)
+
+        await interation.followup.send(
+            f"Migrated {res['migrated']} table(s), {res['up_to_date']} already up to date, "
+            f"{len(res['failed'])} failed",
+            ephemeral=True,
+        )
+
+    @app_commands.command()
+    async def partition(self, interation, guild_id: str = None):
+        """Partitions the table of a guild, or of every guild, by month. Each table is rebuilt while doing so."""
+        if interation.user.id not in owner_ids:
+            return
+
+        await interation.response.defer(ephemeral=True)
+
+        db = self.client.db
+        partitioned = await get_partitions(db)
+        guild_ids = [int(guild_id)] if guild_id else await db.get_guild_ids()
+        guild_ids = [i for i in guild_ids if i not in partitioned]
+
+        failed = 0
+        for i in guild_ids:
+            try:
+                await partition_table(db, i, db.partition_months_ahead)
+                log.info(f"Partitioned the table of guild {i}")
+            except Exception as e:
+                log.error(f"Failed to partition the table of guild {i}: {e}")
+                failed += 1
+
+            await asyncio.sleep(migration_pause)
+
+        await interation.followup.send(
+            f"Partitioned {len(guild_ids) - failed} table(s), {failed} failed", ephemeral=True
         )
 
+    @app_commands.command()
+    async def shards(self, interation):
+        """Shows how many guilds each database backend holds."""
+        if interation.user.id not in owner_ids:
+            return
+
+        await interation.response.defer(ephemeral=True)
+
+        embed = embed_template()
+        embed.title = "Shards"
+
+        for name, count in (await get_shard_counts(self.client.db)).items():
+            embed.add_field(name=name, value=f"{count} guild(s)")
+
+        await interation.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command()
+    async def move_guild(self, interation, guild_id: str, backend: str):
+        """Moves a guild to another database backend. Writes to it wait for a few seconds at the end."""
+        if interation.user.id not in owner_ids:
+            return
+
+        await interation.response.defer(ephemeral=True)
+
+        try:
+            copied = await move_guild(self.client.db, int(guild_id), backend, chunk_size=shard_move_chunk_size)
+        except Exception as e:
+            log.error(f"Failed to move guild {guild_id} to {backend}: {e}")
+            await interation.followup.send(embed=error_template(f"Failed to move the guild: {e}"), ephemeral=True)
+            return
+
+        await interation.followup.send(f"Moved guild {guild_id} to {backend}, {copied} messages copied", ephemeral=True)
+
+    @app_commands.command()
+    async def cache_stats(self, interation):
+        """Shows the hit rates of the query, chart and name caches."""
+        if interation.user.id not in owner_ids:
+            return
+
+        def rate(hits, misses):
+            return f"{hits}/{hits + misses} ({hits / ((hits + misses) or 1):.0%})"
+
+        embed = embed_template()
+        embed.title = "Cache stats"
+
+        for name, (hits, misses) in sorted(query_cache.stats().items()):
+            embed.add_field(name=name, value=rate(hits, misses))
+
+        embed.add_field(name="charts", value=rate(chart_cache.hits, chart_cache.misses))
+        embed.add_field(name="names", value=rate(resolver._names.hits, resolver._names.misses))
+
+        await interation.response.send_message(embed=embed, ephemeral=True)
+
 
 async def setup(client):
     await client.add_cog(Owners(client))
@@ -1,31 +1,300 @@
 """Functions for interacting with the database."""
 
 import asyncio
+import contextlib
+import contextvars
+import functools
+import itertools
+import logging
+import os
+import tempfile
+import time
+
 import aiomysql
 
+from srg_analytics.metrics import db_method_seconds, db_pool_connections, timed_methods
+from srg_analytics.migrations import migrate_table
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+# column order of the rows passed to `DB.add_messages`
+MESSAGE_COLUMNS = (
+    "message_id", "channel_id", "author_id", "aliased_author_id", "message_length", "epoch", "has_embed",
+    "num_attachments",
+)
+MESSAGE_PLACEHOLDER = "(" + ", ".join(["%s"] * len(MESSAGE_COLUMNS)) + ")"
+
+# (db, guild_id, connection, lock) of the `DB.reading` block the current task is in
+_reading = contextvars.ContextVar("reading", default=None)
+
+
+class _GuildMoving(Exception):
+    """Raised in a write's transaction that found its guild being moved, see `DB._check_moving`."""
+
 
+def _retry_moved(func):
+    """Runs a write again when it found its guild being moved, `DB._pool` then waits for the move to finish."""
+    @functools.wraps(func)
+    async def retry(self, guild_id, *args, **kwargs):
+        while True:
+            try:
+                return await func(self, guild_id, *args, **kwargs)
+            except _GuildMoving:
+                self._map_loaded = 0
+                await asyncio.sleep(1)
+
+    return retry
+
+
+@timed_methods(db_method_seconds)
 class DB:
-    """Class for interaction with the database."""
+    """Class for interaction with the database.
 
-    def __init__(self, db_creds, maxsize: int = 10):
+    With `read_creds`, queries made with `read=True` go to that database (a replica kept up to date by a
+    `Replicator`) while it's at most `read_max_staleness` seconds behind according to every one of its
+    `read_heartbeats`, and to the primary otherwise. Only the reads of the guilds in the replica's
+    `replica_seeded` table go there, the replica has none of the messages from before replication of the others.
+
+    With `shards` ({name: creds} of more backends), the guilds are spread over the primary (called `name`) and
+    those backends by a `ShardMap`, and every per-guild call goes to the guild's backend. Overrides of the map are
+    read from the primary's `shard_map` table at most every `shard_refresh` seconds.
+    """
+
+    def __init__(self, db_creds, maxsize: int = 10, minsize: int = 1, local_infile: bool = False,
+                 read_creds=None, read_max_staleness: float = 30.0, read_heartbeats: list = ("replication:listener",),
+                 partition_tables: bool = False, partition_months_ahead: int = 3, name: str = "db1",
+                 shards: dict = None, shard_refresh: float = 5.0):
         self.con = None
         self.db_creds = db_creds
         self.maxsize = maxsize
+        self.minsize = minsize
+        self.local_infile = local_infile
+        self.partition_tables = partition_tables
+        self.partition_months_ahead = partition_months_ahead
+
+        self.read_con = None
+        self.read_creds = read_creds
+        self.read_max_staleness = read_max_staleness
+        self.read_heartbeats = list(read_heartbeats)
 
-        asyncio.create_task(self.connect())  # this doesn't work
+        self._read_fresh = False
+        self._read_checked = 0
+        # the guilds whose data on the replica is complete, loaded with its freshness
+        self._read_seeded = set()
+
+        self.name = name
+        self.shard_creds = {name: db_creds, **(shards or {})}
+        self.shard_refresh = shard_refresh
+        # {name: pool} of every backend, the primary's pool is `con`
+        self.pools = {}
+        self.shard_map = None
+
+        if shards:
+            # imported here, `shards` imports this module
+            from srg_analytics.shards import ShardMap
+            self.shard_map = ShardMap(list(self.shard_creds))
+
+        self._map_loaded = 0
+
+        # set to a `Replicator` to replay the writes made through this object onto another database
+        self.replicator = None
+
+        # {pool: max_allowed_packet}, the backends can be configured differently
+        self._max_packet = {}
+
+        self._connect_lock = asyncio.Lock()
 
     async def connect(self):
-        if self.con is not None:
+        """Creates the connection pool, with `minsize` connections already open, and the data tables.
+
+        Meant to be called once at startup, the DB object is then shared by everything that needs it.
+        """
+        async with self._connect_lock:
+            if self.con is not None:
+                return
+
+            for name, creds in self.shard_creds.items():
+                self.pools[name] = await aiomysql.create_pool(
+                    **creds, autocommit=True, minsize=self.minsize, maxsize=self.maxsize,
+                    local_infile=self.local_infile,
+                )
+
+                # every backend has every table, the ones only used on the primary stay empty elsewhere
+                await self._create_data_tables(self.pools[name])
+
+            self.con = self.pools[self.name]
+            db_pool_connections.add_function(self._pool_stats)
+
+            if self.shard_map is not None:
+                await self._adopt_guilds()
+
+    async def close(self):
+        """Closes the connection pools, waiting for the connections in use to be released."""
+        if self.read_con is not None:
+            self.read_con.close()
+            await self.read_con.wait_closed()
+            self.read_con = None
+
+        if self.con is None:
             return
 
-        self.con = await aiomysql.create_pool(**self.db_creds, autocommit=True, maxsize=self.maxsize)
+        db_pool_connections.remove_function(self._pool_stats)
+
+        for pool in self.pools.values():
+            pool.close()
+            await pool.wait_closed()
+
+        self.pools = {}
+        self.con = None
+
+    def _pool_stats(self) -> dict:
+        """Returns {(pool, state): connections} for the `srg_db_pool_connections` metric."""
+        pools = dict(self.pools)
+        if self.read_con is not None:
+            pools["replica"] = self.read_con
+
+        stats = {}
+        for name, pool in pools.items():
+            stats[(name, "used")] = pool.size - pool.freesize
+            stats[(name, "free")] = pool.freesize
+            stats[(name, "max")] = pool.maxsize
+
+        return stats
+
+    async def _pool(self, guild_id: int, write: bool = False):
+        """Returns the pool of the guild's backend. With `write`, waits while the guild is being moved."""
+        if self.shard_map is None:
+            return self.con
+
+        while True:
+            if time.monotonic() - self._map_loaded >= self.shard_refresh:
+                await self.load_shard_map()
+
+            name, frozen = self.shard_map.locate(guild_id)
+
+            if not (write and frozen):
+                break
+
+            # writes made now would be missed by the move, see `shards.move_guild`
+            await asyncio.sleep(1)
+            self._map_loaded = 0
+
+        if name not in self.pools:
+            raise ValueError(f"guild {guild_id} is on the backend {name}, which isn't configured")
+
+        return self.pools[name]
+
+    async def is_frozen(self, guild_id: int) -> bool:
+        """Whether writes to the guild are held up by a move, without waiting for it to finish.
+
+        Goes by the last loaded shard map if the primary can't be reached.
+        """
+        if self.shard_map is None:
+            return False
+
+        if time.monotonic() - self._map_loaded >= self.shard_refresh:
+            try:
+                await self.load_shard_map()
+            except Exception as e:
+                log.warning(f"DB: couldn't reload the shard map: {e}")
+
+        return self.shard_map.locate(guild_id)[1]
+
+    async def load_shard_map(self):
+        """Reloads the overrides of the shard map from the primary."""
+        res = await self._execute(self.con, "SELECT guild_id, shard, target, moving_since FROM shard_map;", fetch="all")
+
+        self.shard_map.overrides = {guild_id: (shard, target, moving_since) for guild_id, shard, target, moving_since in res}
+        self._map_loaded = time.monotonic()
+
+    async def _adopt_guilds(self):
+        """Pins the guilds that are stored somewhere else than where the shard map puts them, e.g. every guild
+        that was added before sharding was turned on or before a backend was added, so nothing moves on its own.
+        """
+        await self.load_shard_map()
+
+        pinned = []
+        for name, pool in self.pools.items():
+            for (table,) in await self._execute(pool, "SHOW TABLES;", fetch="all"):
+                if not str(table).isdigit() or int(table) in self.shard_map.overrides:
+                    continue
+
+                if self.shard_map.ring_shard(int(table)) != name:
+                    pinned.append((int(table), name))
+
+        if pinned:
+            await self._execute(
+                self.con,
+                f"INSERT IGNORE INTO shard_map (guild_id, shard) VALUES {', '.join(['(%s, %s)'] * len(pinned))};",
+                [value for row in pinned for value in row],
+            )
+            log.info(f"DB: pinned {len(pinned)} guilds to the backends they are stored on")
+
+            await self.load_shard_map()
+
+    async def execute_on_shards(self, query, args=None) -> list:
+        """Runs a query on every backend, returning all the rows it fetched."""
+        rows = []
 
-        await self._create_data_tables()
+        for pool in self.pools.values():
+            rows.extend(await self._execute(pool, query, args, fetch="all"))
 
-    async def _create_data_tables(self):
+        return rows
+
+    async def _read_pool(self, pool, guild_id: int = None):
+        """Returns the pool reads go to, the replica if it's fresh enough (checked at most every 5 seconds) and
+        has all of the guild's data, and `pool` otherwise.
+        """
+        if self.read_creds is None:
+            return pool
+
+        if time.monotonic() - self._read_checked >= 5:
+            self._read_checked = time.monotonic()
+            fresh = await self._replica_fresh()
+
+            if fresh != self._read_fresh:
+                log.info(f"DB: reading from the {'replica' if fresh else 'primary'}")
+            self._read_fresh = fresh
+
+        if not self._read_fresh or (guild_id is not None and guild_id not in self._read_seeded):
+            return pool
+
+        return self.read_con
+
+    async def _replica_fresh(self) -> bool:
+        try:
+            if self.read_con is None:
+                self.read_con = await aiomysql.create_pool(
+                    **self.read_creds, autocommit=True, minsize=1, maxsize=self.maxsize
+                )
+
+            async with self.read_con.acquire() as conn:
+                async with conn.cursor() as cur:
+                    # the replica is as fresh as the stalest of the processes replicating to it
+                    await cur.execute(
+                        f"SELECT MIN(last_seen), COUNT(*) FROM heartbeats "
+                        f"WHERE name IN ({', '.join(['%s'] * len(self.read_heartbeats))});",
+                        self.read_heartbeats,
+                    )
+                    last_seen, count = await cur.fetchone()
+
+                    await cur.execute("SELECT guild_id FROM replica_seeded;")
+                    self._read_seeded = {i[0] for i in await cur.fetchall()}
+
+        except Exception as e:
+            log.warning(f"DB: the replica can't be read from: {e}")
+            return False
+
+        return count == len(self.read_heartbeats) and time.time() - last_seen <= self.read_max_staleness
+
+    def _replicate(self, op: str, *args):
+        if self.replicator is not None:
+            self.replicator.record(op, *args)
+
+    async def _create_data_tables(self, pool):
         # check if the "data" table exists, if not, create it
 
-        async with self.con.acquire() as conn:
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
@@ -56,10 +325,196 @@ class DB:
                     """
                 )
 
-    async def add_guild(self, guild_id):
-        """Adds a guild (database), with boilerplate table."""
-        async with self.con.acquire() as conn:
+                # per-hour totals for every (guild, channel, author), kept up to date by the write methods
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS rollup_hourly (
+                        guild_id BIGINT NOT NULL,
+                        hour BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        aliased_author_id BIGINT NOT NULL,
+                        messages INT NOT NULL DEFAULT 0,
+                        characters BIGINT NOT NULL DEFAULT 0,
+                        attachments INT NOT NULL DEFAULT 0,
+                        embeds INT NOT NULL DEFAULT 0,
+                        PRIMARY KEY (guild_id, hour, channel_id, aliased_author_id),
+                        KEY author_hour (guild_id, aliased_author_id, hour)
+                    );
+                    """
+                )
+
+                # bumped by every write to a guild's data, cached results are keyed by it
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS guild_versions (
+                        guild_id BIGINT NOT NULL,
+                        version BIGINT NOT NULL,
+                        PRIMARY KEY (guild_id)
+                    );
+                    """
+                )
+
+                # the migration (see `migrations.py`) each guild's table is at
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_versions (
+                        guild_id BIGINT NOT NULL,
+                        version INT NOT NULL,
+                        PRIMARY KEY (guild_id)
+                    );
+                    """
+                )
+
+                # the newest and oldest message stored for each harvested channel, so harvests only fetch
+                # what's missing. `complete` is set once the channel's history has been read back to its start
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS harvest_progress (
+                        guild_id BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        newest_id BIGINT,
+                        oldest_id BIGINT,
+                        complete BOOLEAN NOT NULL DEFAULT FALSE,
+                        PRIMARY KEY (guild_id, channel_id)
+                    );
+                    """
+                )
+
+                # the last time each process (e.g. "listener") was known to be running, in epoch seconds
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS heartbeats (
+                        name VARCHAR(64) NOT NULL,
+                        last_seen DOUBLE NOT NULL,
+                        PRIMARY KEY (name)
+                    );
+                    """
+                )
+
+                # windows in which a listener process missed messages, removed once they have been backfilled
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS listener_gaps (
+                        listener VARCHAR(64) NOT NULL DEFAULT 'listener',
+                        gap_start DOUBLE NOT NULL,
+                        gap_end DOUBLE NOT NULL,
+                        PRIMARY KEY (listener, gap_start, gap_end)
+                    );
+                    """
+                )
+
+                # tables created while there was a single listener process have no `listener` column
+                await cur.execute("SHOW COLUMNS FROM listener_gaps LIKE 'listener';")
+                if await cur.fetchone() is None:
+                    await cur.execute(
+                        "ALTER TABLE listener_gaps ADD COLUMN listener VARCHAR(64) NOT NULL DEFAULT 'listener' FIRST, "
+                        "DROP PRIMARY KEY, ADD PRIMARY KEY (listener, gap_start, gap_end);"
+                    )
+
+                # large deletions, done in the background by `DeletionWorker` a chunk at a time. `kind` is
+                # "channel", "author" (with `target_id`) or "guild"
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS deletion_jobs (
+                        id BIGINT NOT NULL AUTO_INCREMENT,
+                        kind VARCHAR(16) NOT NULL,
+                        guild_id BIGINT NOT NULL,
+                        target_id BIGINT,
+                        status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                        deleted BIGINT NOT NULL DEFAULT 0,
+                        created DOUBLE NOT NULL,
+                        finished DOUBLE,
+                        affected TEXT,
+                        last_id BIGINT NOT NULL DEFAULT -1,
+                        PRIMARY KEY (id),
+                        KEY status (status)
+                    );
+                    """
+                )
+
+                # `affected` is the comma separated aliased IDs whose rollups an author deletion has to rebuild,
+                # saved before its first chunk since the deleted messages can't tell anymore
+                await cur.execute("SHOW COLUMNS FROM deletion_jobs LIKE 'affected';")
+                if await cur.fetchone() is None:
+                    await cur.execute("ALTER TABLE deletion_jobs ADD COLUMN affected TEXT;")
+
+                # `last_id` is the highest message ID deleted so far, the next chunk starts after it
+                await cur.execute("SHOW COLUMNS FROM deletion_jobs LIKE 'last_id';")
+                if await cur.fetchone() is None:
+                    await cur.execute("ALTER TABLE deletion_jobs ADD COLUMN last_id BIGINT NOT NULL DEFAULT -1;")
+
+                # guilds with an archive table (see `archive.py`), every message in it has an ID below `cutoff_id`
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS archive_state (
+                        guild_id BIGINT NOT NULL,
+                        cutoff_id BIGINT NOT NULL,
+                        PRIMARY KEY (guild_id)
+                    );
+                    """
+                )
+
+                # the guilds that aren't on the backend the shard map's ring puts them on (see `shards.py`),
+                # `target` and `moving_since` are set while a guild is being moved
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS shard_map (
+                        guild_id BIGINT NOT NULL,
+                        shard VARCHAR(64) NOT NULL,
+                        target VARCHAR(64),
+                        moving_since DOUBLE,
+                        PRIMARY KEY (guild_id)
+                    );
+                    """
+                )
+
+                # guilds whose rollups cover all of their messages, only these are read from the rollups
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS rollup_ready (
+                        guild_id BIGINT NOT NULL,
+                        PRIMARY KEY (guild_id)
+                    );
+                    """
+                )
+
+                # on a replica, the guilds it has every message of: created through replication while they were new,
+                # or seeded with a copy of the primary. Reads of the other guilds stay on the primary
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS replica_seeded (
+                        guild_id BIGINT NOT NULL,
+                        PRIMARY KEY (guild_id)
+                    );
+                    """
+                )
+
+                # the guilds whose rollups are being rebuilt (see `rebuild_rollups`), the messages up to `watermark`
+                # are counted. `aliased_author_ids` is comma separated, NULL when every author is rebuilt
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS rollup_rebuilds (
+                        guild_id BIGINT NOT NULL,
+                        watermark BIGINT NOT NULL,
+                        last_id BIGINT NOT NULL,
+                        aliased_author_ids TEXT,
+                        PRIMARY KEY (guild_id)
+                    );
+                    """
+                )
+
+    async def add_guild(self, guild_id, complete: bool = None):
+        """Adds a guild (database), with boilerplate table.
+
+        `complete` is given on a replica, whether the guild was new on the primary too. A table created for a guild
+        that already had messages there isn't marked as having complete rollups or as seeded.
+        """
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
+                await cur.execute("SHOW TABLES LIKE %s;", (str(guild_id),))
+                is_new = await cur.fetchone() is None
+
                 await cur.execute(
                     f"""
                 CREATE TABLE IF NOT EXISTS `{guild_id}` (
@@ -76,16 +531,111 @@ class DB:
                 """
                 )
 
+                # a new guild has no messages yet, so its (empty) rollups are complete
+                if is_new and complete is not False:
+                    await cur.execute("INSERT IGNORE INTO rollup_ready (guild_id) VALUES (%s);", (guild_id,))
+
+                    if complete:
+                        await cur.execute("INSERT IGNORE INTO replica_seeded (guild_id) VALUES (%s);", (guild_id,))
+
+        if is_new:
+            # brings the new table up to the current schema, instant while it's empty. Existing tables are left to
+            # the throttled migration runner, an ALTER of a large one takes long
+            await migrate_table(self, guild_id)
+
+        if is_new and self.partition_tables:
+            # imported here, `partitions` needs `helpers`, which imports this module
+            from srg_analytics.partitions import partition_table
+            await partition_table(self, guild_id, self.partition_months_ahead)
+
+        self._replicate("add_guild", guild_id, is_new)
+
+    async def set_replica_seeded(self, guild_id: int):
+        """Marks the guild's data on this database, a replica, as complete, e.g. once a copy of the primary's is
+        loaded into it. Its reads go to the replica from then on.
+        """
+        await self.execute("INSERT IGNORE INTO replica_seeded (guild_id) VALUES (%s);", (guild_id,), guild_id=guild_id)
+
     async def remove_guild(self, guild_id):
         """Removes the guild from the database."""
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(f"DROP TABLE IF EXISTS `{guild_id}`;")
+                await cur.execute(f"DROP TABLE IF EXISTS `{guild_id}_archive`;")
+                await cur.execute("DELETE FROM archive_state WHERE guild_id = %s;", (guild_id,))
+                await cur.execute("DELETE FROM rollup_hourly WHERE guild_id = %s;", (guild_id,))
+                await cur.execute("DELETE FROM rollup_ready WHERE guild_id = %s;", (guild_id,))
+                await cur.execute("DELETE FROM schema_versions WHERE guild_id = %s;", (guild_id,))
+                await cur.execute("DELETE FROM harvest_progress WHERE guild_id = %s;", (guild_id,))
+                await cur.execute("DELETE FROM replica_seeded WHERE guild_id = %s;", (guild_id,))
+                await self._bump_version(cur, guild_id)
 
                 # await cur.execute(f"DELETE FROM config WHERE data1 = '{guild_id}';") # TODO
 
-    async def execute(self, query, args=None, fetch=None):
-        async with self.con.acquire() as conn:
+        if self.shard_map is not None:
+            await self.execute("DELETE FROM shard_map WHERE guild_id = %s;", (guild_id,))
+
+        self._replicate("remove_guild", guild_id)
+
+    @contextlib.asynccontextmanager
+    async def reading(self, guild_id: int):
+        """Runs the guild's queries made with `read` inside the block on a single connection, in one snapshot.
+
+        The reads a query is built from (`rollups_ready`, `get_archive_cutoff`...) then see the same database and
+        the same data as the query itself, even if the replica turns stale or the guild is written to meanwhile.
+        """
+        session = _reading.get()
+        if session is not None and session[0] is self and session[1] == guild_id:
+            yield
+            return
+
+        pool = await self._read_pool(await self._pool(guild_id), guild_id)
+
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY;")
+
+            token = _reading.set((self, guild_id, conn, asyncio.Lock()))
+            try:
+                yield
+            finally:
+                _reading.reset(token)
+                await conn.rollback()
+
+    async def execute(self, query, args=None, fetch=None, read: bool = False, guild_id: int = None):
+        """Runs a query, with `read` on the replica if there's a fresh one (see `DB`).
+
+        Queries of a guild's tables, or of its rows in the tables keyed by guild, must pass its `guild_id` so they
+        go to its backend. Other queries go to the primary. Inside a `reading` block of the guild, reads go to the
+        block's connection.
+        """
+        session = _reading.get()
+        if read and session is not None and session[0] is self and session[1] == guild_id:
+            # tasks started in the block share its connection, which runs one query at a time
+            async with session[3]:
+                async with session[2].cursor() as cur:
+                    await cur.execute(query.replace("?", "%s"), args)
+                    if fetch == "all":
+                        return await cur.fetchall()
+                    elif fetch == "one":
+                        return await cur.fetchone()
+                    return
+
+        home = await self._pool(guild_id, write=not read) if guild_id is not None else self.con
+        pool = await self._read_pool(home, guild_id) if read else home
+
+        if pool is not home:
+            try:
+                return await self._execute(pool, query, args, fetch)
+            except aiomysql.OperationalError as e:
+                log.warning(f"DB: the replica failed, reading from the primary: {e}")
+                self._read_fresh = False
+
+        return await self._execute(home, query, args, fetch)
+
+    async def _execute(self, pool, query, args=None, fetch=None):
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(query.replace("?", "%s"), args)
                 if fetch is None:
@@ -102,140 +652,902 @@ class DB:
 
         if selected is None:
             selected = ["*"]
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(f"SELECT {', '.join(selected)} FROM `{guild_id}`;")
 
                 return await cur.fetchall()
 
     async def get_guilds(self):  # TODO TEST
-        async with self.con.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SHOW TABLES;")
+        return await self.execute_on_shards("SHOW TABLES;")
 
-                return await cur.fetchall()
+    async def get_guild_ids(self) -> list:
+        """Returns the IDs of every guild with a messages table."""
+        # a guild that's being moved has a table on two backends
+        return list(dict.fromkeys(int(i[0]) for i in await self.get_guilds() if str(i[0]).isdigit()))
+
+    async def get_schema_version(self, guild_id: int) -> int:
+        res = await self.execute(
+            "SELECT version FROM schema_versions WHERE guild_id = %s;", (guild_id,), fetch="one", guild_id=guild_id
+        )
+
+        return res[0] if res else 0
+
+    async def get_schema_versions(self) -> dict:
+        """Returns {guild_id: schema version} for every guild table that has been migrated."""
+        return dict(await self.execute_on_shards("SELECT guild_id, version FROM schema_versions;"))
+
+    async def set_schema_version(self, guild_id: int, version: int):
+        await self.execute(
+            "INSERT INTO schema_versions (guild_id, version) VALUES (%s, %s) "
+            "ON DUPLICATE KEY UPDATE version = VALUES(version);",
+            (guild_id, version), guild_id=guild_id,
+        )
 
     async def add_message(self, guild_id: int, data: dict):
         """Adds a message to the database."""
-        async with self.con.acquire() as conn:
+        await self.add_messages(guild_id, [tuple(data[column] for column in MESSAGE_COLUMNS)])
+
+    @_retry_moved
+    async def add_messages(self, guild_id: int, rows: list):
+        """Adds many messages to the database with a single multi-row insert.
+
+        Each row is a tuple in `MESSAGE_COLUMNS` order.
+        """
+        if not rows:
+            return
+
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    f"""
-                        INSERT IGNORE INTO `{guild_id}` (message_id, channel_id, author_id, aliased_author_id, message_length, epoch, 
-                        has_embed, num_attachments)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-                    """,
-                    (
-                        str(data['message_id']),
-                        str(data['channel_id']),
-                        str(data['author_id']),
-                        str(data['aliased_author_id']),
-                        str(data['message_length']),
-                        str(data['epoch']),
-                        str(data['has_embed']),
-                        str(data['num_attachments']),
-                    ),
+                await conn.begin()
+                try:
+                    rebuild = await self._get_rebuild(cur, guild_id)
+                    await self._lock_guild(cur, guild_id)
+                    await self._check_moving(cur, guild_id)
+
+                    # messages older than the archive cutoff belong in the archive table, e.g. when history is read
+                    # again, so they are neither stored nor counted twice
+                    cutoff = await self._get_archive_cutoff(cur, guild_id)
+                    tables = {}
+                    for row in rows:
+                        tables.setdefault(self._message_table(guild_id, row[0], cutoff), []).append(row)
+
+                    rows = []
+                    for table, table_rows in tables.items():
+                        # messages that are already stored mustn't be counted in the rollups twice. A locking read sees
+                        # the rows committed by the previous writer, and keeps the bulk loads from adding them meanwhile
+                        await cur.execute(
+                            f"SELECT message_id FROM {table} "
+                            f"WHERE message_id IN ({', '.join(['%s'] * len(table_rows))}) FOR UPDATE;",
+                            [row[0] for row in table_rows],
+                        )
+                        stored = {i[0] for i in await cur.fetchall()}
+                        table_rows = [row for row in table_rows if row[0] not in stored]
+
+                        if table_rows:
+                            await cur.execute(
+                                f"INSERT IGNORE INTO {table} ({', '.join(MESSAGE_COLUMNS)}) "
+                                f"VALUES {', '.join([MESSAGE_PLACEHOLDER] * len(table_rows))};",
+                                [value for row in table_rows for value in row],
+                            )
+                            rows.extend(table_rows)
+
+                    if rows:
+                        await self._update_rollups(cur, guild_id, rows, rebuild=rebuild)
+                        await self._bump_version(cur, guild_id)
+
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+
+        if rows:
+            self._replicate("add_messages", guild_id, rows)
+
+    async def _lock_guild(self, cur, guild_id: int):
+        """Locks the guild's `guild_versions` row until the transaction ends, so writes that update the rollups
+        are made one at a time. Take it right after `_get_rebuild`, before any message is read or written.
+        """
+        await cur.execute(
+            "INSERT INTO guild_versions (guild_id, version) VALUES (%s, 1) ON DUPLICATE KEY UPDATE version = version;",
+            (guild_id,),
+        )
+
+    async def _check_moving(self, cur, guild_id: int):
+        """Raises `_GuildMoving` if the guild is being moved off the backend the transaction is on.
+
+        `shards.move_guild` marks the move in the backend's `shard_map` before the final sync. The shared lock makes
+        the mark wait for the writes already under way, so they are all synced, and the later ones see it.
+        """
+        if self.shard_map is None:
+            return
+
+        # imported here, `shards` imports this module
+        from srg_analytics.shards import FREEZE_TIMEOUT
 
+        await cur.execute(
+            "SELECT target, moving_since FROM shard_map WHERE guild_id = %s LOCK IN SHARE MODE;", (guild_id,)
+        )
+        res = await cur.fetchone()
+
+        if res is not None and res[0] is not None and time.time() - res[1] < FREEZE_TIMEOUT:
+            raise _GuildMoving(guild_id)
+
+    async def _bump_version(self, cur, guild_id: int):
+        """Marks the guild's data as changed, invalidating everything cached for it."""
+        await cur.execute(
+            "INSERT INTO guild_versions (guild_id, version) VALUES (%s, 1) ON DUPLICATE KEY UPDATE version = version + 1;",
+            (guild_id,),
+        )
+
+    async def _get_rebuild(self, cur, guild_id: int):
+        """Returns (watermark, last_id, aliased author IDs or None) of the guild's running rollup rebuild, or None.
+
+        Call it first in the write's transaction. The shared lock keeps the rebuild from counting the messages past
+        the watermark until the write is committed, so it counts them as they are after it.
+        """
+        await cur.execute(
+            "SELECT watermark, last_id, aliased_author_ids FROM rollup_rebuilds WHERE guild_id = %s "
+            "LOCK IN SHARE MODE;",
+            (guild_id,),
+        )
+        res = await cur.fetchone()
+
+        if res is None:
+            return None
+
+        watermark, last_id, author_ids = res
+        return watermark, last_id, {int(i) for i in author_ids.split(",") if i} if author_ids is not None else None
+
+    async def _update_rollups(self, cur, guild_id: int, rows: list, sign: int = 1, rebuild: tuple = None):
+        """Adds (or with sign=-1, subtracts) rows in `MESSAGE_COLUMNS` order to the hourly rollups.
+
+        Rows that the running `rebuild` (see `_get_rebuild`) hasn't reached yet are left out, it counts them itself.
+        """
+        if rebuild is not None:
+            watermark, last_id, author_ids = rebuild
+            rows = [
+                row for row in rows
+                if not (watermark < row[0] <= last_id and (author_ids is None or (row[3] or row[2]) in author_ids))
+            ]
+
+        if not rows:
+            return
+
+        totals = {}
+
+        for message_id, channel_id, author_id, aliased_author_id, message_length, epoch, has_embed, \
+                num_attachments in rows:
+            key = (int(epoch) - int(epoch) % 3600, channel_id, aliased_author_id or author_id)
+            total = totals.setdefault(key, [0, 0, 0, 0])
+
+            total[0] += 1
+            total[1] += message_length or 0
+            total[2] += num_attachments or 0
+            total[3] += 1 if has_embed else 0
+
+        await cur.execute(
+            f"""
+            INSERT INTO rollup_hourly (guild_id, hour, channel_id, aliased_author_id, messages, characters, 
+            attachments, embeds)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(totals))}
+            ON DUPLICATE KEY UPDATE messages = messages + VALUES(messages), 
+            characters = characters + VALUES(characters), attachments = attachments + VALUES(attachments), 
+            embeds = embeds + VALUES(embeds);
+            """,
+            [value for key, total in totals.items() for value in (guild_id, *key, *(sign * i for i in total))],
+        )
+
+    async def rebuild_rollups(self, guild_id: int, aliased_author_ids: list = None, chunk_size: int = 100000):
+        """Recomputes the hourly rollups of a guild (or only of some authors) from its messages.
+
+        Used to backfill guilds that have messages from before the rollups existed, and after alias changes.
+        The messages are read in primary key order, `chunk_size` at a time, so no single statement scans the
+        whole table.
+
+        Messages are written to while the rollups are rebuilt. The rebuild's progress is kept in `rollup_rebuilds`,
+        and the write methods only update the rollups for the messages it has counted or won't count.
+        """
+        author_filter = ""
+        author_ids = None
+        if aliased_author_ids is not None:
+            author_ids = ','.join(str(int(i)) for i in aliased_author_ids)
+            author_filter = f"AND COALESCE(aliased_author_id, author_id) IN ({author_ids})"
+
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                # one rebuild of a guild at a time, `rollup_rebuilds` holds the progress of a single one. Held by the
+                # connection, so it's released if the process dies
+                await cur.execute("SELECT GET_LOCK(%s, -1);", (f"rebuild_rollups:{guild_id}",))
+                await cur.fetchone()
+
+                try:
+                    await self._rebuild_rollups(conn, cur, guild_id, aliased_author_ids, author_ids, author_filter,
+                                                chunk_size)
+                finally:
+                    await cur.execute("SELECT RELEASE_LOCK(%s);", (f"rebuild_rollups:{guild_id}",))
+                    await cur.fetchone()
+
+        # rebuilds for alias changes are made on the replica by the replicated alias change itself
+        if aliased_author_ids is None:
+            self._replicate("rebuild_rollups", guild_id)
+
+    async def _rebuild_rollups(self, conn, cur, guild_id: int, aliased_author_ids: list, author_ids: str,
+                               author_filter: str, chunk_size: int):
+        """The body of `rebuild_rollups`, run while holding the guild's rebuild lock."""
+        await conn.begin()
+        try:
+            # taken first, so the writes in progress are committed before the rollups are emptied and the
+            # messages are counted
+            await cur.execute(
+                "REPLACE INTO rollup_rebuilds (guild_id, watermark, last_id, aliased_author_ids) "
+                "VALUES (%s, -1, -1, %s);",
+                (guild_id, author_ids),
+            )
+
+            tables = await self._message_tables(cur, guild_id)
+
+            # messages stored after this point are added to the rollups by the write methods themselves
+            last_id = -1
+            for table in tables:
+                await cur.execute(f"SELECT MAX(message_id) FROM {table};")
+                last_id = max(last_id, (await cur.fetchone())[0] or -1)
+
+            await cur.execute("UPDATE rollup_rebuilds SET last_id = %s WHERE guild_id = %s;", (last_id, guild_id))
+
+            if aliased_author_ids is None:
+                await cur.execute("DELETE FROM rollup_ready WHERE guild_id = %s;", (guild_id,))
+                await cur.execute("DELETE FROM rollup_hourly WHERE guild_id = %s;", (guild_id,))
+            else:
+                await cur.execute(
+                    f"DELETE FROM rollup_hourly WHERE guild_id = %s "
+                    f"AND aliased_author_id IN ({', '.join(['%s'] * len(aliased_author_ids))});",
+                    (guild_id, *aliased_author_ids),
                 )
 
-    async def add_messages_bulk(self, guild_id, message_ids, channel_ids, author_ids, aliased_author_ids,
-                                message_lengths, epoches, has_embeds, num_attachments):
-        async with self.con.acquire() as conn:
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+        try:
+            # each chunk is the same range of IDs in every table, the watermark being where it ends
+            lower = -1
+            while lower < last_id:
+                upper = last_id
+                for table in tables:
+                    await cur.execute(
+                        f"SELECT message_id FROM {table} WHERE message_id > %s ORDER BY message_id "
+                        f"LIMIT 1 OFFSET %s;",
+                        (lower, chunk_size - 1),
+                    )
+                    res = await cur.fetchone()
+                    if res is not None:
+                        upper = min(upper, res[0])
+
+                # the watermark is moved with the chunk, and waits for the writes that skipped it
+                await conn.begin()
+                try:
+                    await cur.execute(
+                        "UPDATE rollup_rebuilds SET watermark = %s WHERE guild_id = %s;", (upper, guild_id)
+                    )
+
+                    for table in tables:
+                        await cur.execute(
+                            f"""
+                            INSERT INTO rollup_hourly (guild_id, hour, channel_id, aliased_author_id, messages, 
+                            characters, attachments, embeds)
+                            SELECT %s, epoch - epoch %% 3600 AS hour, channel_id, 
+                            COALESCE(aliased_author_id, author_id) AS author, COUNT(*), 
+                            COALESCE(SUM(message_length), 0), SUM(num_attachments), SUM(has_embed)
+                            FROM {table}
+                            WHERE message_id > %s AND message_id <= %s {author_filter}
+                            GROUP BY hour, channel_id, author
+                            ON DUPLICATE KEY UPDATE messages = messages + VALUES(messages), 
+                            characters = characters + VALUES(characters), 
+                            attachments = attachments + VALUES(attachments), embeds = embeds + VALUES(embeds);
+                            """,
+                            (guild_id, lower, upper),
+                        )
+
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+
+                lower = upper
+
+            if aliased_author_ids is None:
+                await cur.execute("INSERT IGNORE INTO rollup_ready (guild_id) VALUES (%s);", (guild_id,))
+
+            await self._bump_version(cur, guild_id)
+
+        finally:
+            await cur.execute("DELETE FROM rollup_rebuilds WHERE guild_id = %s;", (guild_id,))
+
+    async def rollups_ready(self, guild_id: int, read: bool = False) -> bool:
+        """Whether the guild's hourly rollups are complete and can be read instead of its messages.
+
+        Pass the same `read` as the queries the answer is used for, the replica's rollups can be behind.
+        """
+        return await self.execute(
+            "SELECT 1 FROM rollup_ready WHERE guild_id = %s;", (guild_id,), fetch="one", read=read, guild_id=guild_id
+        ) is not None
+
+    async def _get_max_packet(self, pool, cur) -> int:
+        if pool not in self._max_packet:
+            await cur.execute("SELECT @@max_allowed_packet;")
+            self._max_packet[pool] = (await cur.fetchone())[0]
+
+        return self._max_packet[pool]
+
+    async def add_messages_bulk(self, guild_id: int, rows, use_infile: bool = None, rebuild_rollups: bool = True,
+                                infile_rows: int = 500000) -> int:
+        """Loads a large number of rows in `MESSAGE_COLUMNS` order, returning the number of rows stored.
+
+        Rows are sent as multi-row `INSERT IGNORE` statements as large as `max_allowed_packet` allows, or with
+        `use_infile` (defaults to the `local_infile` the DB was created with) as `LOAD DATA LOCAL INFILE` from a
+        CSV file in memory backed storage, `infile_rows` rows per file. `rows` can be any iterable, e.g. a generator.
+
+        Unlike `add_messages`, rows aren't checked against the stored ones one by one and the rollups aren't
+        updated per row. The guild's rollups are marked as not ready, so the analytics read the messages directly,
+        and with `rebuild_rollups` they are rebuilt once everything is loaded. Callers loading in many calls
+        should pass False and call `rebuild_rollups` themselves at the end.
+        """
+        if use_infile is None:
+            use_infile = self.local_infile
+
+        if self.replicator is not None:
+            # read twice, once to load and once to replicate
+            rows = list(rows)
+
+        stored = 0
+
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.executemany(
-                    f"""
-                        INSERT IGNORE INTO `{guild_id}` (message_id, channel_id, author_id, message_length, epoch, 
-                        has_embed, num_attachments)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s);
-                    """,
-                    (
-                        message_ids,
-                        channel_ids,
-                        author_ids,
-                        aliased_author_ids,
-                        message_lengths,
-                        epoches,
-                        has_embeds,
-                        num_attachments,
+                await cur.execute("DELETE FROM rollup_ready WHERE guild_id = %s;", (guild_id,))
+                cutoff = await self._get_archive_cutoff(cur, guild_id)
+
+                if use_infile:
+                    stored = await self._load_infile(cur, guild_id, rows, infile_rows, cutoff)
+                else:
+                    stored = await self._insert_batches(pool, cur, guild_id, rows, cutoff)
+
+                await self._bump_version(cur, guild_id)
+
+        self._replicate("add_messages_bulk", guild_id, rows, None, False)
+
+        if rebuild_rollups:
+            await self.rebuild_rollups(guild_id)
+
+        return stored
+
+    async def _insert_batches(self, pool, cur, guild_id: int, rows, cutoff: int = None) -> int:
+        heads = {
+            table: f"INSERT IGNORE INTO {table} ({', '.join(MESSAGE_COLUMNS)}) VALUES "
+            for table in (f"`{guild_id}`", f"`{guild_id}_archive`")
+        }
+        # leave room for the statement itself and the protocol's overhead
+        budget = await self._get_max_packet(pool, cur) - max(len(i) for i in heads.values()) - 1024
+
+        stored = 0
+        # a batch per table, rows older than the archive cutoff go to the archive table
+        batches = {table: [] for table in heads}
+        sizes = {table: 0 for table in heads}
+
+        async def send(table):
+            nonlocal stored
+            await cur.execute(heads[table] + ", ".join([MESSAGE_PLACEHOLDER] * len(batches[table])) + ";",
+                              [value for row_ in batches[table] for value in row_])
+            stored += cur.rowcount
+            batches[table] = []
+            sizes[table] = 0
+
+        for row in rows:
+            table = self._message_table(guild_id, row[0], cutoff)
+            # every value is a number, a bool or None, so its length as text is at least its escaped length
+            row_size = sum(len(str(i)) for i in row) + 2 * len(row) + 2
+
+            if batches[table] and sizes[table] + row_size > budget:
+                await send(table)
+
+            batches[table].append(row)
+            sizes[table] += row_size
+
+        for table in heads:
+            if batches[table]:
+                await send(table)
+
+        return stored
+
+    async def _load_infile(self, cur, guild_id: int, rows, infile_rows: int, cutoff: int = None) -> int:
+        stored = 0
+        # tmpfs, so the CSV never touches the disk
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+        def to_csv(row):
+            return ",".join("\\N" if i is None else str(int(i)) for i in row)
+
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, infile_rows))
+            if not chunk:
+                break
+
+            # a file per table, rows older than the archive cutoff go to the archive table
+            tables = {}
+            for row in chunk:
+                tables.setdefault(self._message_table(guild_id, row[0], cutoff), []).append(to_csv(row))
+
+            for table, lines in tables.items():
+                with tempfile.NamedTemporaryFile("w", suffix=".csv", dir=directory) as file:
+                    file.write("\n".join(lines) + "\n")
+                    file.flush()
+
+                    await cur.execute(
+                        f"LOAD DATA LOCAL INFILE '{file.name}' IGNORE INTO TABLE {table} "
+                        f"FIELDS TERMINATED BY ',' LINES TERMINATED BY '\\n' ({', '.join(MESSAGE_COLUMNS)});"
                     )
-                )
+                    stored += cur.rowcount
+
+        return stored
+
+    async def _get_message_row(self, cur, guild_id: int, message_id: int) -> tuple:
+        """Returns (table, row) of a message, looking in the archive table too, or (None, None) if it isn't stored."""
+        for table in await self._message_tables(cur, guild_id):
+            await cur.execute(
+                f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM {table} WHERE message_id = %s FOR UPDATE;", (message_id,)
+            )
+            row = await cur.fetchone()
+
+            if row is not None:
+                return table, row
+
+        return None, None
+
+    async def _get_archive_cutoff(self, cur, guild_id: int):
+        await cur.execute("SELECT cutoff_id FROM archive_state WHERE guild_id = %s;", (guild_id,))
+        res = await cur.fetchone()
+
+        return res[0] if res is not None else None
+
+    @staticmethod
+    def _message_table(guild_id: int, message_id: int, cutoff: int = None) -> str:
+        """The table a message belongs in, the archive table if it's older than the guild's archive cutoff."""
+        if cutoff is not None and message_id < cutoff:
+            return f"`{guild_id}_archive`"
+
+        return f"`{guild_id}`"
+
+    async def _message_tables(self, cur, guild_id: int) -> list:
+        """Returns the guild's messages table, and its archive table if it has one."""
+        await cur.execute("SELECT 1 FROM archive_state WHERE guild_id = %s;", (guild_id,))
+
+        if await cur.fetchone() is None:
+            return [f"`{guild_id}`"]
+
+        return [f"`{guild_id}`", f"`{guild_id}_archive`"]
+
+    async def get_archive_cutoff(self, guild_id: int, read: bool = False):
+        """Returns the ID every archived message of the guild is below, or None if it has no archive table."""
+        res = await self.execute(
+            "SELECT cutoff_id FROM archive_state WHERE guild_id = %s;", (guild_id,), fetch="one", read=read,
+            guild_id=guild_id,
+        )
+        return res[0] if res is not None else None
+
+    async def create_archive_table(self, guild_id: int):
+        """Creates the guild's compressed table for archived messages."""
+        await self.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS `{guild_id}_archive` (
+            message_id BIGINT NOT NULL,
+            channel_id BIGINT NOT NULL,
+            author_id BIGINT NOT NULL,
+            aliased_author_id BIGINT,
+            message_length BIGINT,
+            epoch BIGINT NOT NULL,
+            has_embed BOOLEAN NOT NULL,
+            num_attachments SMALLINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (message_id),
+            KEY author_epoch (aliased_author_id, epoch),
+            KEY channel_epoch (channel_id, epoch),
+            KEY raw_author (author_id)
+            ) ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8;
+            """,
+            guild_id=guild_id,
+        )
+        await self.execute(
+            "INSERT IGNORE INTO archive_state (guild_id, cutoff_id) VALUES (?, 0);", (guild_id,), guild_id=guild_id
+        )
+
+    @_retry_moved
+    async def archive_messages(self, guild_id: int, cutoff_id: int, chunk_size: int = 10000) -> int:
+        """Moves up to `chunk_size` of the oldest messages with IDs below `cutoff_id` to the archive table, returning
+        how many were moved. The rollups don't change, the messages are only stored elsewhere.
+        """
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await conn.begin()
+                try:
+                    await self._check_moving(cur, guild_id)
+
+                    await cur.execute(
+                        f"SELECT message_id FROM `{guild_id}` WHERE message_id < %s ORDER BY message_id "
+                        f"LIMIT 1 OFFSET %s;",
+                        (cutoff_id, chunk_size - 1),
+                    )
+                    res = await cur.fetchone()
+                    upper = res[0] if res is not None else cutoff_id - 1
 
+                    columns = ", ".join(MESSAGE_COLUMNS)
+                    await cur.execute(
+                        f"INSERT IGNORE INTO `{guild_id}_archive` ({columns}) "
+                        f"SELECT {columns} FROM `{guild_id}` WHERE message_id <= %s;",
+                        (upper,),
+                    )
+                    await cur.execute(f"DELETE FROM `{guild_id}` WHERE message_id <= %s;", (upper,))
+                    moved = cur.rowcount
+
+                    # everything below the cutoff can be in the archive from now on
+                    await cur.execute(
+                        "UPDATE archive_state SET cutoff_id = GREATEST(cutoff_id, %s) WHERE guild_id = %s;",
+                        (upper + 1, guild_id),
+                    )
+
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+
+        return moved
+
+    @_retry_moved
     async def delete_message(self, guild_id: int, message_id: int):
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(f"DELETE FROM `{guild_id}` WHERE message_id = {message_id};")
+                await conn.begin()
+                try:
+                    rebuild = await self._get_rebuild(cur, guild_id)
+                    await self._lock_guild(cur, guild_id)
+                    await self._check_moving(cur, guild_id)
+                    table, row = await self._get_message_row(cur, guild_id, message_id)
+
+                    if row is not None:
+                        await cur.execute(f"DELETE FROM {table} WHERE message_id = {message_id};")
+                        await self._update_rollups(cur, guild_id, [row], sign=-1, rebuild=rebuild)
+                        await self._bump_version(cur, guild_id)
+
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
 
+        self._replicate("delete_message", guild_id, message_id)
+
+    @_retry_moved
     async def edit_message(
             self, guild_id: int, message_id: int, message_length: int, has_embed: bool, num_attachments: int,
     ):
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await conn.begin()
+                try:
+                    rebuild = await self._get_rebuild(cur, guild_id)
+                    await self._lock_guild(cur, guild_id)
+                    await self._check_moving(cur, guild_id)
+                    table, row = await self._get_message_row(cur, guild_id, message_id)
+
+                    if row is not None:
+                        await cur.execute(
+                            f"UPDATE {table} SET message_length = %s, has_embed = %s, num_attachments = %s WHERE message_id = %s;",
+                            (
+                                message_length,
+                                has_embed,
+                                num_attachments,
+                                message_id,
+                            ),
+                        )
+
+                        # swap the old version of the message for the new one in the rollups
+                        await self._update_rollups(cur, guild_id, [row], sign=-1, rebuild=rebuild)
+                        await self._update_rollups(
+                            cur, guild_id, [(*row[:4], message_length, row[5], has_embed, num_attachments)],
+                            rebuild=rebuild,
+                        )
+                        await self._bump_version(cur, guild_id)
+
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+
+        self._replicate("edit_message", guild_id, message_id, message_length, has_embed, num_attachments)
+
+    async def delete_channel(self, guild_id: int, channel_id: int):
+        """Deletes every message of a channel, and the channel's rollups."""
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
+                for table in await self._message_tables(cur, guild_id):
+                    await cur.execute(f"DELETE FROM {table} WHERE `channel_id` = %s;", (channel_id,))
                 await cur.execute(
-                    f"UPDATE `{guild_id}` SET message_length = %s, has_embed = %s, num_attachments = %s WHERE message_id = %s;",
-                    (
-                        message_length,
-                        has_embed,
-                        num_attachments,
-                        message_id,
-                    ),
+                    "DELETE FROM rollup_hourly WHERE guild_id = %s AND channel_id = %s;", (guild_id, channel_id)
                 )
+                await cur.execute(
+                    "DELETE FROM harvest_progress WHERE guild_id = %s AND channel_id = %s;", (guild_id, channel_id)
+                )
+                await self._bump_version(cur, guild_id)
+
+        self._replicate("delete_channel", guild_id, channel_id)
+
+    async def get_author_aliases(self, guild_id: int, author_id: int) -> set:
+        """Returns the aliased IDs a user's messages are counted under in the rollups, their own ID included."""
+        affected = {author_id}
+
+        pool = await self._pool(guild_id)
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for table in await self._message_tables(cur, guild_id):
+                    await cur.execute(
+                        f"SELECT DISTINCT COALESCE(aliased_author_id, author_id) FROM {table} WHERE author_id = %s;",
+                        (author_id,),
+                    )
+                    affected |= {i[0] for i in await cur.fetchall()}
+
+        return affected
+
+    async def delete_author(self, guild_id: int, author_id: int, affected: set = None):
+        """Deletes every message of a user, and rebuilds the rollups they were counted in.
+
+        `affected` adds aliased IDs to rebuild, the ones of messages already deleted by `delete_messages_chunk`.
+        """
+        affected = (affected or set()) | await self.get_author_aliases(guild_id, author_id)
+
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for table in await self._message_tables(cur, guild_id):
+                    await cur.execute(f"DELETE FROM {table} WHERE author_id = %s;", (author_id,))
+
+        await self.rebuild_rollups(guild_id, aliased_author_ids=list(affected))
+
+        self._replicate("delete_author", guild_id, author_id)
+
+    async def delete_messages_chunk(self, guild_id: int, column: str = None, value: int = None,
+                                    limit: int = 5000, after: int = -1) -> tuple:
+        """Deletes up to `limit` messages, the ones with the lowest IDs above `after` where `column` is `value` (or
+        any message), and returns (how many were deleted, the highest ID deleted or `after`). Each call is short, so
+        ingest isn't held up by its locks.
+
+        Pass the returned ID as `after` to the next call, so it doesn't scan the rows before it again. The archive
+        table is emptied first, its IDs being the lowest, so fewer than `limit` means none are left.
+        """
+        where = f"AND {column} = %s" if column is not None else ""
+        deleted = 0
+
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for table in reversed(await self._message_tables(cur, guild_id)):
+                    await cur.execute(
+                        f"SELECT message_id FROM {table} WHERE message_id > %s {where} ORDER BY message_id "
+                        f"LIMIT {int(limit) - deleted};",
+                        (after, value) if column is not None else (after,),
+                    )
+                    ids = [i[0] for i in await cur.fetchall()]
+
+                    if ids:
+                        await cur.execute(
+                            f"DELETE FROM {table} WHERE message_id IN ({', '.join(['%s'] * len(ids))});", ids
+                        )
+                        deleted += len(ids)
+                        after = ids[-1]
+
+                    if deleted >= limit:
+                        break
+
+                await self._bump_version(cur, guild_id)
+
+        return deleted, after
+
+    async def queue_deletion(self, kind: str, guild_id: int, target_id: int = None):
+        """Queues a deletion for `DeletionWorker`, see the `deletion_jobs` table."""
+        await self.execute(
+            "INSERT INTO deletion_jobs (kind, guild_id, target_id, created) VALUES (?, ?, ?, ?);",
+            (kind, guild_id, target_id, time.time()),
+        )
+
+    async def get_deletion_jobs(self, statuses: tuple = ("pending", "running")) -> list:
+        """Returns [(id, kind, guild_id, target_id, status, deleted, last_id)] of the jobs in `statuses`, oldest
+        first.
+        """
+        return list(await self.execute(
+            f"SELECT id, kind, guild_id, target_id, status, deleted, last_id FROM deletion_jobs "
+            f"WHERE status IN ({', '.join(['?'] * len(statuses))}) ORDER BY id;",
+            statuses, fetch="all",
+        ))
+
+    async def update_deletion_job(self, job_id: int, status: str = None, deleted: int = 0, last_id: int = None):
+        """Adds `deleted` to the job's progress, and sets its status and `last_id` if given."""
+        await self.execute(
+            "UPDATE deletion_jobs SET deleted = deleted + ?, status = COALESCE(?, status), "
+            "last_id = COALESCE(?, last_id), finished = IF(? IN ('done', 'failed', 'cancelled'), ?, finished) "
+            "WHERE id = ?;",
+            (deleted, status, last_id, status, time.time(), job_id),
+        )
+
+    async def add_deletion_affected(self, job_id: int, affected: set) -> set:
+        """Adds aliased IDs to the job's `affected`, and returns all of them."""
+        res = await self.execute("SELECT affected FROM deletion_jobs WHERE id = ?;", (job_id,), fetch="one")
+
+        if res is not None and res[0]:
+            affected = affected | {int(i) for i in res[0].split(",")}
+
+        await self.execute(
+            "UPDATE deletion_jobs SET affected = ? WHERE id = ?;", (",".join(str(i) for i in sorted(affected)), job_id)
+        )
+
+        return affected
+
+    async def cancel_deletions(self, guild_id: int, kind: str):
+        """Cancels the guild's pending and running deletions of `kind`."""
+        await self.execute(
+            "UPDATE deletion_jobs SET status = 'cancelled', finished = ? "
+            "WHERE guild_id = ? AND kind = ? AND status IN ('pending', 'running');",
+            (time.time(), guild_id, kind),
+        )
+
+    async def get_harvest_progress(self, guild_id: int, channel_id: int):
+        """Returns (newest_id, oldest_id, complete) for a channel, or None if it was never harvested."""
+        res = await self.execute(
+            "SELECT newest_id, oldest_id, complete FROM harvest_progress WHERE guild_id = ? AND channel_id = ?;",
+            (guild_id, channel_id), fetch="one", guild_id=guild_id,
+        )
+
+        if res is None:
+            return None
+
+        return res[0], res[1], bool(res[2])
+
+    async def set_harvest_progress(self, guild_id: int, channel_id: int, newest_id: int, oldest_id: int,
+                                   complete: bool):
+        await self.execute(
+            "INSERT INTO harvest_progress (guild_id, channel_id, newest_id, oldest_id, complete) "
+            "VALUES (?, ?, ?, ?, ?) ON DUPLICATE KEY UPDATE newest_id = VALUES(newest_id), "
+            "oldest_id = VALUES(oldest_id), complete = VALUES(complete);",
+            (guild_id, channel_id, newest_id, oldest_id, complete), guild_id=guild_id,
+        )
+
+    async def set_heartbeat(self, name: str, last_seen: float = None):
+        await self.execute(
+            "INSERT INTO heartbeats (name, last_seen) VALUES (?, ?) ON DUPLICATE KEY UPDATE last_seen = VALUES(last_seen);",
+            (name, last_seen if last_seen is not None else time.time()),
+        )
+
+    async def get_heartbeat(self, name: str):
+        """Returns the last time `name` was known to be running, or None if it never was."""
+        res = await self.execute("SELECT last_seen FROM heartbeats WHERE name = ?;", (name,), fetch="one")
+        return res[0] if res is not None else None
+
+    async def add_listener_gap(self, start: float, end: float, listener: str = "listener"):
+        await self.execute(
+            "INSERT IGNORE INTO listener_gaps (listener, gap_start, gap_end) VALUES (?, ?, ?);", (listener, start, end)
+        )
+
+    async def get_listener_gaps(self, listener: str = "listener") -> list:
+        """Returns [(start, end)] of the windows the listener process hasn't backfilled yet, oldest first."""
+        return list(await self.execute(
+            "SELECT gap_start, gap_end FROM listener_gaps WHERE listener = ? ORDER BY gap_start;", (listener,),
+            fetch="all",
+        ))
+
+    async def remove_listener_gap(self, start: float, end: float, listener: str = "listener"):
+        await self.execute(
+            "DELETE FROM listener_gaps WHERE listener = ? AND gap_start = ? AND gap_end = ?;", (listener, start, end)
+        )
+
+    async def clear_harvest_progress(self, guild_id: int):
+        """Forgets what was harvested in a guild, so the next harvest reads every channel from the start."""
+        await self.execute("DELETE FROM harvest_progress WHERE guild_id = ?;", (guild_id,), guild_id=guild_id)
 
     async def add_user_alias(self, guild_id: int, user_id: int, alias_id: int, update_existing: bool = True):
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     "INSERT IGNORE INTO `aliases` (guild_id, user_id, alias_id) VALUES (%s, %s, %s);",
                     (guild_id, user_id, alias_id),
                 )
                 if update_existing:
-                    # replace all existing aliases with the new one
-                    await cur.execute(
-                        f"UPDATE `{guild_id}` SET aliased_author_id = {user_id} WHERE author_id = {alias_id};"
-                    )
+                    affected = {user_id, alias_id}
+
+                    for table in await self._message_tables(cur, guild_id):
+                        # the rollups of whoever the alias' messages were counted for change too
+                        await cur.execute(
+                            f"SELECT DISTINCT COALESCE(aliased_author_id, author_id) FROM {table} WHERE author_id = {alias_id};"
+                        )
+                        affected |= {i[0] for i in await cur.fetchall()}
+
+                        # replace all existing aliases with the new one
+                        await cur.execute(
+                            f"UPDATE {table} SET aliased_author_id = {user_id} WHERE author_id = {alias_id};"
+                        )
+
+        if update_existing:
+            await self.rebuild_rollups(guild_id, aliased_author_ids=list(affected))
+
+        self._replicate("add_user_alias", guild_id, user_id, alias_id, update_existing)
 
     async def remove_user_alias(self, guild_id: int, user_id: int, alias_id: int, update_existing: bool = True):
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id, write=True)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     "DELETE FROM `aliases` WHERE guild_id = %s AND user_id = %s AND alias_id = %s;",
                     (guild_id, user_id, alias_id),
                 )
                 if update_existing:
-                    # replace all existing aliases with the new one
-                    await cur.execute(
-                        f"UPDATE `{guild_id}` SET aliased_author_id = NULL WHERE author_id = {alias_id};"
-                    )
+                    affected = {alias_id}
+
+                    for table in await self._message_tables(cur, guild_id):
+                        await cur.execute(
+                            f"SELECT DISTINCT COALESCE(aliased_author_id, author_id) FROM {table} WHERE author_id = {alias_id};"
+                        )
+                        affected |= {i[0] for i in await cur.fetchall()}
+
+                        # replace all existing aliases with the new one
+                        await cur.execute(
+                            f"UPDATE {table} SET aliased_author_id = NULL WHERE author_id = {alias_id};"
+                        )
+
+        if update_existing:
+            await self.rebuild_rollups(guild_id, aliased_author_ids=list(affected))
+
+        self._replicate("remove_user_alias", guild_id, user_id, alias_id, update_existing)
 
     async def get_user_aliases(self, guild_id: int = None):
         final_dict = {}
 
-        async with self.con.acquire() as conn:
-            async with conn.cursor() as cur:
+        if guild_id is None:
+            res = await self.execute_on_shards(
+                f"SELECT guild_id, alias_id, user_id FROM `aliases`;",
+            )
 
-                if guild_id is None:
-                    await cur.execute(
-                        f"SELECT guild_id, alias_id, user_id FROM `aliases`;",
-                    )
+            # { guild_id: {alias_id: user_id, ...}, ...}
+            for guild_id, user_id, alias_id in res:
+                final_dict[guild_id][alias_id]: user_id
 
-                    res = await cur.fetchall()
+        else:
+            res = await self.execute(
+                "SELECT alias_id, user_id FROM `aliases` WHERE guild_id = %s;",
+                (guild_id,), fetch="all", guild_id=guild_id,
+            )
 
-                    # { guild_id: {alias_id: user_id, ...}, ...}
-                    for guild_id, user_id, alias_id in res:
-                        final_dict[guild_id][alias_id]: user_id
+            # {alias_id: user_id}
+            for user_id, alias_id in res:
+                final_dict[alias_id]: user_id
 
-                else:
-                    await cur.execute(
-                        "SELECT alias_id, user_id FROM `aliases` WHERE guild_id = %s;",
-                        (guild_id,),
-                    )
+        return final_dict
 
-                    res = await cur.fetchall()
+    async def get_data_version(self, guild_id: int) -> int:
+        """Returns the guild's write version, which every write to its messages, rollups or aliases bumps.
 
-                    # {alias_id: user_id}
-                    for user_id, alias_id in res:
-                        final_dict[alias_id]: user_id
+        Read from wherever the analytics are read from, so cached results are keyed by the version they saw.
+        """
+        res = await self.execute(
+            "SELECT version FROM guild_versions WHERE guild_id = %s;", (guild_id,), fetch="one", read=True,
+            guild_id=guild_id,
+        )
 
-        return final_dict
+        return res[0] if res else 0
 
     async def set_timezone(self, guild_id: int, timezone: int):
         # timezone here is an offset from UTC
@@ -273,7 +1585,8 @@ class DB:
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
 
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(query, tuple(params))
                 return (await cur.fetchone())[0]
@@ -295,7 +1608,8 @@ class DB:
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
 
-        async with self.con.acquire() as conn:
+        pool = await self._pool(guild_id)
+        async with pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(query, tuple(params))
                 return (await cur.fetchone())[0]
@@ -1,7 +1,20 @@
 from .activity import *
+from .archive import *
+from .cache import *
 from .DB import *
+from .deletion import *
+from .harvest import *
 from .helpers import *
+from .ingest import *
+from .metrics import *
+from .migrations import *
+from .partitions import *
 from .schemas import *
+from .shards import *
+from .spool import *
 from .top import *
 from .profile import *
 from .profile import build_profile
+from .render import *
+from .replication import *
+from .resolver import *
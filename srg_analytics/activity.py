@@ -1,14 +1,14 @@
 import io
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
-import mplcyberpunk
-import aiomysql
 import pandas as pd
 from datetime import datetime
-from backend import get_db_creds
 
+from srg_analytics.DB import DB
+from srg_analytics.helpers import messages_source, snowflake_range
+from srg_analytics.render import renderer
 
-async def activity_server(server_id, start_date: datetime.date, end_date: datetime.date, timezone_offset: int = +3):
+
+async def activity_server(db: DB, server_id, start_date: datetime.date, end_date: datetime.date,
+                          timezone_offset: int = +3):
     # Ensure end_date is at least 3 days after start_date
     if (end_date - start_date).days < 3:
         raise ValueError("end_date must be at least 3 days after start_date.")
@@ -33,25 +33,44 @@ async def activity_server(server_id, start_date: datetime.date, end_date: dateti
     end_epoch = int(end_date.timestamp()) - timezone_offset * 3600
 
     # SQL query to fetch message counts
-    query = f"""
-        SELECT 
-            {group_by} AS period,
-            COUNT(*) AS message_count
-        FROM 
-            `{server_id}`
-        WHERE 
-            epoch BETWEEN %s AND %s
-        GROUP BY 
-            period
-        ORDER BY 
-            period ASC;
-    """
-
-    # Fetch data from the database
-    async with aiomysql.connect(**get_db_creds('onsite')) as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(query, (timezone_offset, start_epoch, end_epoch))
-            result = await cursor.fetchall()
+    # the readiness, the archive cutoff and the messages are read from the same database
+    async with db.reading(server_id):
+        if await db.rollups_ready(server_id, read=True):
+            # every period is at least a day long and the offset is in whole hours, so the hourly rollups give the
+            # same series without touching the messages table
+            query = f"""
+                SELECT 
+                    {group_by.replace("epoch", "hour")} AS period,
+                    CAST(SUM(messages) AS SIGNED) AS message_count
+                FROM 
+                    rollup_hourly
+                WHERE 
+                    guild_id = %s AND hour BETWEEN %s AND %s
+                GROUP BY 
+                    period
+                ORDER BY 
+                    period ASC;
+            """
+            args = (timezone_offset, server_id, start_epoch - start_epoch % 3600, end_epoch)
+        else:
+            query = f"""
+                SELECT 
+                    {group_by} AS period,
+                    COUNT(*) AS message_count
+                FROM 
+                    {await messages_source(db, server_id, start_epoch, read=True)}
+                WHERE 
+                    message_id BETWEEN %s AND %s
+                GROUP BY 
+                    period
+                ORDER BY 
+                    period ASC;
+            """
+            # the epoch window as a range of the primary key, see `snowflake_range`
+            args = (timezone_offset, *snowflake_range(start_epoch, end_epoch))
+
+        # Fetch data from the database
+        result = await db.execute(query, args, fetch="all", read=True, guild_id=server_id)
 
     # Convert the results into a DataFrame
     df = pd.DataFrame(result, columns=['period', 'message_count'])
@@ -72,35 +91,16 @@ async def activity_server(server_id, start_date: datetime.date, end_date: dateti
     df = full_range.merge(df, on='date', how='left').fillna(0)
     df['message_count'] = df['message_count'].astype(int)
 
-    # Plotting
-    plt.style.use("cyberpunk")  # Apply mplcyberpunk style
-
-    fig, ax = plt.subplots(figsize=(12, 6), dpi=120)
-    ax.plot(df['date'], df['message_count'], label="Messages", marker='o')
-
-    # Format x-axis labels properly
-    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
-    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
-
-    plt.xticks(rotation=45, ha='right')
-    ax.set_xlabel('Date')
-    ax.set_ylabel('Number of Messages')
-    ax.set_title('Activity Server: Messages Over Time')
-
-    mplcyberpunk.add_glow_effects()
-
-    # Save and close the plot
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300)
-    buf.seek(0)
-    plt.close()
+    # Plotting, done in a worker process
+    png = await renderer.series(
+        [("Messages", df['date'].dt.to_pydatetime().tolist(), df['message_count'].tolist())],
+        'Activity Server: Messages Over Time'
+    )
 
-    return buf
+    return io.BytesIO(png)
 
 
-async def activity_user(server_id, user_ids: list, user_nicknames: list, start_date: datetime.date,
+async def activity_user(db: DB, server_id, user_ids: list, user_nicknames: list, start_date: datetime.date,
                         end_date: datetime.date, timezone_offset: int = +3):
     if len(user_ids) != len(user_nicknames):
         raise ValueError("The number of user IDs must match the number of user nicknames.")
@@ -125,58 +125,73 @@ async def activity_user(server_id, user_ids: list, user_nicknames: list, start_d
     start_epoch = int(start_date.timestamp()) - timezone_offset * 3600
     end_epoch = int(end_date.timestamp()) - timezone_offset * 3600
 
-    plt.style.use("cyberpunk")
-    fig, ax = plt.subplots(figsize=(12, 6), dpi=120)
-
-    async with aiomysql.connect(**get_db_creds('onsite')) as conn:
-        async with conn.cursor() as cursor:
-            for user_id, nickname in zip(user_ids, user_nicknames):
-                query = f"""
-                    SELECT 
-                        {group_by} AS period,
-                        COUNT(*) AS message_count
-                    FROM 
-                        `{server_id}`
-                    WHERE 
-                        epoch BETWEEN %s AND %s AND aliased_author_id = %s
-                    GROUP BY 
-                        period
-                    ORDER BY 
-                        period ASC;
-                """
-                await cursor.execute(query, (timezone_offset, start_epoch, end_epoch, user_id))
-                result = await cursor.fetchall()
-
-                df = pd.DataFrame(result, columns=['period', 'message_count'])
-
-                if freq == "W-MON":
-                    df['date'] = df['period'].astype(str).apply(lambda x: datetime.strptime(x + '-1', "%Y%W-%w"))
-                elif freq in ["D", "MS", "AS"]:
-                    df['date'] = pd.to_datetime(df['period'])
-
-                df.drop(columns=['period'], inplace=True)
-                full_range = pd.DataFrame(
-                    {'date': pd.date_range(start=min(df['date']), end=max(df['date']), freq=freq)})
-                merged_df = full_range.merge(df, on='date', how='left').fillna(0)
-                merged_df['message_count'] = merged_df['message_count'].astype(int)
-
-                ax.plot(merged_df['date'], merged_df['message_count'], marker='o', label=nickname)
-
-    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
-    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
-    plt.xticks(rotation=45, ha='right')
-    ax.set_xlabel('Date')
-    ax.set_ylabel('Number of Messages')
-    ax.set_title('User Activity Over Time')
-    ax.legend()
-
-    mplcyberpunk.add_glow_effects()
-
-    plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300)
-    buf.seek(0)
-    plt.close()
-
-    return buf
+    # every user's series in one scan, grouped by (user, period)
+    # the readiness, the archive cutoff and the messages are read from the same database
+    async with db.reading(server_id):
+        if await db.rollups_ready(server_id, read=True):
+            query = f"""
+                SELECT 
+                    aliased_author_id,
+                    {group_by.replace("epoch", "hour")} AS period,
+                    CAST(SUM(messages) AS SIGNED) AS message_count
+                FROM 
+                    rollup_hourly
+                WHERE 
+                    guild_id = %s AND hour BETWEEN %s AND %s 
+                    AND aliased_author_id IN ({', '.join(['%s'] * len(user_ids))})
+                GROUP BY 
+                    aliased_author_id, period
+                ORDER BY 
+                    aliased_author_id, period ASC;
+            """
+            args = (timezone_offset, server_id, start_epoch - start_epoch % 3600, end_epoch, *user_ids)
+        else:
+            query = f"""
+                SELECT 
+                    COALESCE(aliased_author_id, author_id) AS author,
+                    {group_by} AS period,
+                    COUNT(*) AS message_count
+                FROM 
+                    {await messages_source(db, server_id, start_epoch, read=True)}
+                WHERE 
+                    message_id BETWEEN %s AND %s 
+                    AND COALESCE(aliased_author_id, author_id) IN ({', '.join(['%s'] * len(user_ids))})
+                GROUP BY 
+                    author, period
+                ORDER BY 
+                    author, period ASC;
+            """
+            args = (timezone_offset, *snowflake_range(start_epoch, end_epoch), *user_ids)
+
+        result = await db.execute(query, args, fetch="all", read=True, guild_id=server_id)
+
+    rows = {user_id: [] for user_id in user_ids}
+    for user_id, period, message_count in result:
+        rows[user_id].append((period, message_count))
+
+    series = []
+    for user_id, nickname in zip(user_ids, user_nicknames):
+        if not rows[user_id]:
+            continue
+
+        df = pd.DataFrame(rows[user_id], columns=['period', 'message_count'])
+
+        if freq == "W-MON":
+            df['date'] = df['period'].astype(str).apply(lambda x: datetime.strptime(x + '-1', "%Y%W-%w"))
+        elif freq in ["D", "MS", "AS"]:
+            df['date'] = pd.to_datetime(df['period'])
+
+        df.drop(columns=['period'], inplace=True)
+        full_range = pd.DataFrame(
+            {'date': pd.date_range(start=min(df['date']), end=max(df['date']), freq=freq)})
+        merged_df = full_range.merge(df, on='date', how='left').fillna(0)
+        merged_df['message_count'] = merged_df['message_count'].astype(int)
+
+        series.append(
+            (nickname, merged_df['date'].dt.to_pydatetime().tolist(), merged_df['message_count'].tolist())
+        )
+
+    png = await renderer.series(series, 'User Activity Over Time', legend=True)
+
+    return io.BytesIO(png)
 
@@ -0,0 +1,60 @@
+"""Moving old messages out of the guild tables into compressed archive tables.
+
+Most queries only cover recent windows, which then never read the archived messages, keeping the guild tables
+(and the buffer pool) small. The rollups are untouched, they keep covering every message. Windows that reach back
+past the archive cutoff read both tables, see `helpers.messages_source`.
+"""
+
+import asyncio
+import logging
+import time
+
+from srg_analytics.DB import DB
+from srg_analytics.helpers import epoch_to_snowflake
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+
+async def archive_guild(db: DB, guild_id: int, age_days: int, chunk_size: int = 10000, pause: float = 0.5) -> int:
+    """Moves a guild's messages older than `age_days` days to its archive table, returning how many were moved."""
+    cutoff_id = epoch_to_snowflake(time.time() - age_days * 86400)
+
+    if await db.get_archive_cutoff(guild_id) is None:
+        # only guilds with messages to archive get an archive table
+        if await db.execute(
+            f"SELECT 1 FROM `{guild_id}` WHERE message_id < %s LIMIT 1;", (cutoff_id,), fetch="one", guild_id=guild_id
+        ) is None:
+            return 0
+
+        await db.create_archive_table(guild_id)
+
+    moved = 0
+
+    while True:
+        count = await db.archive_messages(guild_id, cutoff_id, chunk_size)
+        moved += count
+
+        if count < chunk_size:
+            return moved
+
+        await asyncio.sleep(pause)
+
+
+async def archive_all(db: DB, age_days: int, chunk_size: int = 10000, pause: float = 0.5) -> int:
+    """Archives the old messages of every guild, returning how many were moved."""
+    moved = 0
+
+    for guild_id in await db.get_guild_ids():
+        try:
+            count = await archive_guild(db, guild_id, age_days, chunk_size, pause)
+        except Exception as e:
+            log.error(f"Archive: failed to archive guild {guild_id}: {e}")
+            continue
+
+        if count:
+            log.debug(f"Archive: moved {count} messages of guild {guild_id}")
+            moved += count
+
+    log.info(f"Archive: moved {moved} messages older than {age_days} days")
+
+    return moved
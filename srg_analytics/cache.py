@@ -0,0 +1,109 @@
+"""In-memory caches for query results, rendered charts and resolved names."""
+
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """A bounded mapping that evicts the least recently used entry once `maxsize` entries are stored.
+
+    Entries can be given a `ttl` in seconds, after which they count as missing.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + ttl if ttl is not None else None, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+def _normalize(params):
+    """Turns params into something hashable that doesn't depend on argument order."""
+    if isinstance(params, dict):
+        return tuple(sorted((key, _normalize(value)) for key, value in params.items()))
+    if isinstance(params, (list, tuple, set)):
+        return tuple(_normalize(i) for i in params)
+    return params
+
+
+class QueryCache:
+    """Caches query results keyed by guild, query name, normalized params and the guild's write version.
+
+    Any write to a guild bumps its version (see `DB.get_data_version`), so stale results are never returned for
+    it. Results whose window moves with the clock (e.g. "today") are only kept for `ttl` seconds, while results
+    that can only change through writes (e.g. all time, or a window in the past) are kept for `historical_ttl`.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, historical_ttl: float = 86400):
+        self.ttl = ttl
+        self.historical_ttl = historical_ttl
+
+        self.hits = {}
+        self.misses = {}
+
+        self._results = LRUCache(maxsize=maxsize)
+
+    async def get_or_run(self, db, guild_id: int, name: str, params, run, historical: bool = False):
+        """Returns the cached result for the query, or awaits `run()` and caches what it returns."""
+        key = (guild_id, name, _normalize(params), await db.get_data_version(guild_id))
+
+        res = self._results.get(key, _MISSING)
+        if res is not _MISSING:
+            self.hits[name] = self.hits.get(name, 0) + 1
+            return res
+
+        self.misses[name] = self.misses.get(name, 0) + 1
+
+        # what the query reads to decide how to run is read on the same connection as the query itself
+        async with db.reading(guild_id):
+            res = await run()
+        self._results.set(key, res, ttl=self.historical_ttl if historical else self.ttl)
+
+        return res
+
+    def stats(self) -> dict:
+        """Returns {query name: (hits, misses)}."""
+        return {
+            name: (self.hits.get(name, 0), self.misses.get(name, 0)) for name in {*self.hits, *self.misses}
+        }
+
+    def clear(self):
+        self._results.clear()
+
+
+# PNG bytes keyed by (guild_id, chart type, params, data version)
+chart_cache = LRUCache(maxsize=64)
+
+query_cache = QueryCache()
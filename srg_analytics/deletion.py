@@ -0,0 +1,104 @@
+"""Background worker for large deletions, so event handlers never hold locks on a guild's table."""
+
+import asyncio
+import logging
+
+from srg_analytics.DB import DB
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+# the column whose messages a job of each kind deletes, None meaning every message
+_COLUMNS = {"channel": "channel_id", "author": "author_id", "guild": None}
+
+
+class DeletionWorker:
+    """Works through the `deletion_jobs` queued with `DB.queue_deletion`, one job at a time.
+
+    Messages are deleted `chunk_size` at a time in primary key order with a `pause` between chunks, and the job's
+    progress is saved after each chunk, with the last message ID deleted so the next chunk starts after it. Once a
+    job's messages are gone, the cheap remainder of the deletion (the rollups, the guild's table, replication) is
+    done by the matching `DB` method. Jobs left running by a restart are picked up again, deleting is idempotent.
+    """
+
+    def __init__(self, db: DB, chunk_size: int = 5000, pause: float = 0.5, poll_interval: float = 10.0):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.poll_interval = poll_interval
+
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self):
+        """Checks for jobs right away instead of at the next poll, call after queueing one."""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                for job in await self.db.get_deletion_jobs():
+                    await self._run_job(*job)
+            except Exception as e:
+                log.error(f"Deletion: error while checking for jobs: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _run_job(self, job_id: int, kind: str, guild_id: int, target_id: int, status: str, deleted: int,
+                       last_id: int):
+        log.info(f"Deletion: deleting {kind} {target_id or ''} of guild {guild_id} (job {job_id})")
+        await self.db.update_deletion_job(job_id, status="running")
+
+        affected = None
+
+        try:
+            if guild_id in await self.db.get_guild_ids():
+                if kind == "author":
+                    # the aliases are read from the messages, so they're saved before any of them is deleted
+                    affected = await self.db.add_deletion_affected(
+                        job_id, await self.db.get_author_aliases(guild_id, target_id)
+                    )
+
+                while True:
+                    # stop between chunks if the job was cancelled, e.g. the bot rejoined the guild
+                    if job_id not in [i[0] for i in await self.db.get_deletion_jobs()]:
+                        log.info(f"Deletion: job {job_id} was cancelled after {deleted} messages")
+                        return
+
+                    count, last_id = await self.db.delete_messages_chunk(
+                        guild_id, _COLUMNS[kind], target_id, limit=self.chunk_size, after=last_id
+                    )
+                    deleted += count
+                    await self.db.update_deletion_job(job_id, deleted=count, last_id=last_id)
+
+                    if count < self.chunk_size:
+                        break
+
+                    await asyncio.sleep(self.pause)
+
+            if kind == "channel":
+                await self.db.delete_channel(guild_id, target_id)
+            elif kind == "author":
+                await self.db.delete_author(guild_id, target_id, affected)
+            else:
+                await self.db.remove_guild(guild_id)
+
+        except Exception as e:
+            log.error(f"Deletion: job {job_id} failed after {deleted} messages: {e}")
+            await self.db.update_deletion_job(job_id, status="failed")
+            return
+
+        await self.db.update_deletion_job(job_id, status="done")
+        log.info(f"Deletion: job {job_id} done, {deleted} messages deleted")
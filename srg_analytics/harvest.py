@@ -0,0 +1,222 @@
+"""Crawling the message history of many channels and threads of a guild at once."""
+
+import asyncio
+import logging
+import time
+
+import discord
+
+from srg_analytics.helpers import epoch_to_snowflake
+from srg_analytics.ingest import message_row
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+
+async def harvest_targets(channels: list):
+    """Yields every channel and thread under `channels` that can have messages."""
+    for channel in channels:
+        # guild.channel superclasses:
+        # TextChannel, VoiceChannel, CategoryChannel, StageChannel, ForumChannel
+        if isinstance(channel, (discord.TextChannel, discord.VoiceChannel)):
+            yield channel
+
+        if isinstance(channel, (discord.TextChannel, discord.ForumChannel)):
+            for thread in channel.threads:
+                yield thread
+
+            try:
+                async for thread in channel.archived_threads(limit=None):
+                    yield thread
+            except discord.Forbidden:
+                log.debug(f"Harvest: can't list the archived threads of {channel.id}")
+
+
+async def gap_targets(guild, start: float):
+    """Yields the channels and threads of a guild that can have messages from after `start`.
+
+    A channel's last message ID is known from the gateway, so channels that were quiet since `start` are skipped
+    without any requests. Archived threads are only listed for channels with activity since `start`: a message,
+    a new thread, or an active thread of theirs with messages since then.
+    """
+    start_id = epoch_to_snowflake(start)
+
+    def active(channel):
+        return (channel.last_message_id or 0) >= start_id
+
+    for channel in guild.channels:
+        if isinstance(channel, (discord.TextChannel, discord.VoiceChannel)) and active(channel):
+            yield channel
+
+    for thread in guild.threads:
+        if active(thread):
+            yield thread
+
+    # a forum's last message ID is the one of its newest thread
+    active_parents = {thread.parent_id for thread in guild.threads if active(thread)}
+
+    # threads archived since `start` can have messages from before they were archived. Listing them takes requests,
+    # so it's skipped for the channels that were quiet
+    for channel in guild.channels:
+        if not isinstance(channel, (discord.TextChannel, discord.ForumChannel)):
+            continue
+
+        if not active(channel) and channel.id not in active_parents:
+            continue
+
+        try:
+            async for thread in channel.archived_threads(limit=None):
+                if thread.archive_timestamp.timestamp() < start:
+                    break
+
+                if active(thread):
+                    yield thread
+        except discord.Forbidden:
+            pass
+
+
+async def save_history(db, channel, chunk_size: int = 10000, on_chunk=None, bulk: bool = True, **kwargs) -> int:
+    """Streams `channel.history(**kwargs)` into the database `chunk_size` messages at a time.
+
+    `on_chunk(rows)` is awaited after each chunk is stored. Returns the number of messages read. With `bulk`
+    chunks go through `add_messages_bulk`, otherwise through `add_messages`, which keeps the rollups up to date
+    and is meant for small amounts of messages.
+    """
+    store = db.add_messages if not bulk else lambda guild_id, rows: db.add_messages_bulk(
+        guild_id, rows, rebuild_rollups=False
+    )
+
+    read = 0
+    rows = []
+
+    async for message in channel.history(**kwargs):
+        rows.append(message_row(message))
+
+        if len(rows) >= chunk_size:
+            await store(channel.guild.id, rows)
+            if on_chunk is not None:
+                await on_chunk(rows)
+
+            read += len(rows)
+            rows = []
+
+    if rows:
+        await store(channel.guild.id, rows)
+        if on_chunk is not None:
+            await on_chunk(rows)
+
+        read += len(rows)
+
+    return read
+
+
+class Harvest:
+    """Crawls channels with at most `concurrency` of them being read at once.
+
+    `save(channel, harvest)` reads and stores one channel, adding the messages it stores to `harvest.messages`
+    as it goes. Requests are made through discord.py, which waits out the rate limit bucket of each route (the
+    history route is bucketed per channel) and the global rate limit, so parallel channels don't get the bot
+    limited, they only stop waiting on each other.
+    """
+
+    def __init__(self, save, concurrency: int = 8):
+        self.save = save
+        self.concurrency = concurrency
+
+        self.channels_total = 0
+        self.channels_done = 0
+        self.messages = 0
+        self.failed = {}
+        self.listing = True
+
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Messages stored per second."""
+        return self.messages / (self.elapsed or 1)
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds until every listed channel is done, estimated from the channels done so far."""
+        if self.listing or not self.channels_done:
+            return None
+
+        return self.elapsed / self.channels_done * (self.channels_total - self.channels_done)
+
+    async def run(self, targets):
+        """Crawls every channel yielded by the async iterator `targets`, e.g. `harvest_targets(channels)`."""
+        self.started = time.time()
+
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                channel = await queue.get()
+
+                if channel is None:
+                    return
+
+                try:
+                    await self.save(channel, self)
+                except discord.Forbidden:
+                    # no access to the channel's history
+                    pass
+                except Exception as e:
+                    log.error(f"Harvest: failed to harvest channel {channel.id}: {e}")
+                    self.failed[channel.id] = e
+
+                self.channels_done += 1
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+
+        try:
+            async for channel in targets:
+                self.channels_total += 1
+                await queue.put(channel)
+
+            self.listing = False
+
+            for _ in workers:
+                await queue.put(None)
+
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+            self.finished = time.time()
+
+    def summary(self) -> str:
+        eta = self.eta
+        eta = "unknown" if eta is None else f"{int(eta // 60)}m {int(eta % 60)}s"
+
+        return (
+            f"Channels: {self.channels_done}/{self.channels_total}{'+' if self.listing else ''}\n"
+            f"Messages: {self.messages} ({self.rate:.0f} msgs/s)\n"
+            f"Elapsed: {int(self.elapsed // 60)}m {int(self.elapsed % 60)}s\n"
+            f"ETA: {eta if self.finished is None else 'done'}\n"
+            f"Failed: {len(self.failed)}"
+        )
+
+
+async def backfill_gap(db, guild, start: float, end: float, concurrency: int = 4, chunk_size: int = 10000) -> Harvest:
+    """Stores the messages of a guild sent between `start` and `end`, e.g. while the listener was down."""
+    after, before = discord.Object(epoch_to_snowflake(start)), discord.Object(epoch_to_snowflake(end))
+
+    async def save(channel, harvest):
+        async def count(rows):
+            harvest.messages += len(rows)
+
+        await save_history(
+            db, channel, chunk_size, count, bulk=False, limit=None, after=after, before=before, oldest_first=True
+        )
+
+    harvest = Harvest(save, concurrency=concurrency)
+    await harvest.run(gap_targets(guild, start))
+
+    return harvest
@@ -1,4 +1,53 @@
-from srg_analytics.DB import DB
+from srg_analytics.DB import DB, MESSAGE_COLUMNS
+
+# Discord's snowflake epoch (2015-01-01), in milliseconds
+DISCORD_EPOCH = 1420070400000
+
+
+def epoch_to_snowflake(epoch: float) -> int:
+    """Returns the smallest snowflake that can be created at `epoch` (in seconds)."""
+    return max(int(epoch * 1000) - DISCORD_EPOCH, 0) << 22
+
+
+def snowflake_to_epoch(snowflake: int) -> float:
+    return ((snowflake >> 22) + DISCORD_EPOCH) / 1000
+
+
+def snowflake_range(start_epoch: float = None, end_epoch: float = None) -> tuple:
+    """Returns the lowest and highest message IDs that can have an `epoch` within [start_epoch, end_epoch].
+
+    `epoch` is stored in whole seconds, so every message from the last second of the window is included.
+    """
+    low = epoch_to_snowflake(start_epoch) if start_epoch is not None else 0
+    high = epoch_to_snowflake(int(end_epoch) + 1) - 1 if end_epoch is not None else 2 ** 63 - 1
+
+    return low, high
+
+
+def message_id_range(start_epoch: float = None, end_epoch: float = None) -> str:
+    """Builds a condition selecting the messages within an epoch window by their (primary key) message ID.
+
+    Message IDs are snowflakes, which start with their creation time, so this is a range scan on the clustered
+    primary key instead of a scan of the whole table for `epoch`.
+    """
+    low, high = snowflake_range(start_epoch, end_epoch)
+
+    return f"message_id BETWEEN {low} AND {high}"
+
+
+async def messages_source(db: DB, guild_id: int, start_epoch: float = None, read: bool = False) -> str:
+    """Returns what to select a guild's messages from, for a window starting at `start_epoch` (None for all time).
+
+    That's the guild's table, unioned with its archive table (see `archive.py`) only if the window reaches back to
+    the archived messages.
+    """
+    cutoff = await db.get_archive_cutoff(guild_id, read=read)
+
+    if cutoff is None or (start_epoch is not None and epoch_to_snowflake(start_epoch) >= cutoff):
+        return f"`{guild_id}`"
+
+    columns = ", ".join(MESSAGE_COLUMNS)
+    return f"(SELECT {columns} FROM `{guild_id}` UNION ALL SELECT {columns} FROM `{guild_id}_archive`) AS messages"
 
 
 async def is_ignored(db: DB, channel_id: int = None, user_id: int = None):
@@ -0,0 +1,333 @@
+"""Buffered, batched ingestion of messages into the database."""
+
+import asyncio
+import logging
+import time
+
+from srg_analytics.DB import DB
+from srg_analytics.metrics import ingest_flush_seconds, ingest_queue_depth, messages_ingested
+from srg_analytics.spool import Spool
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+
+def message_row(message, aliased_author_id: int = None) -> tuple:
+    """Builds a row in `MESSAGE_COLUMNS` order from a discord message."""
+    return (
+        message.id,
+        message.channel.id,
+        message.author.id,
+        aliased_author_id if aliased_author_id is not None else message.author.id,
+        len(message.content),
+        int(message.created_at.timestamp()),
+        message.embeds != [],
+        len(message.attachments),
+    )
+
+
+class IngestQueue:
+    """Write-behind queue that buffers messages per guild and writes them with multi-row inserts.
+
+    A guild's buffer is flushed once it holds `batch_size` rows or its oldest row is `max_delay` seconds old.
+    `put` waits when `max_pending` rows are buffered across all guilds, so a slow database slows the producers
+    down instead of growing the buffers forever.
+
+    With a `spool`, rows are appended to it instead of being buffered in memory, and `put` only waits once
+    `max_spooled` rows are spooled. The flusher drains the spool into the database in bulk, committing its position
+    only once the rows are written, so rows survive database outages and restarts.
+
+    The rows of a guild that's being moved to another backend (see `shards.move_guild`) are kept buffered, or
+    spooled again, until the move is done, and the other guilds are written meanwhile.
+    """
+
+    def __init__(self, db: DB, batch_size: int = 500, max_delay: float = 2.0, max_pending: int = 20000,
+                 spool: Spool = None, max_spooled: int = 1000000):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.spool = spool
+        self.max_spooled = max_spooled
+
+        self._buffers: dict[int, list] = {}
+        self._oldest: dict[int, float] = {}
+        self._pending = 0
+
+        # a guild's rows are written by one task at a time, so a flush also waits for the write already under way
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._drain_lock = asyncio.Lock()
+
+        # {guild_id: {message_id: row}} of the rows spooled by this process and not written yet, so a single message
+        # can be written ahead of the spool. The ones left by the last run aren't known until the spool is emptied
+        self._spooled: dict[int, dict[int, tuple]] = {}
+        self._backlog = spool is not None and spool.pending > 0
+
+        self._wakeup = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+
+        self._task = None
+        self._closed = False
+
+        ingest_queue_depth.add_function(self._get_depth)
+
+    def _get_depth(self) -> int:
+        return self.depth
+
+    @property
+    def depth(self) -> int:
+        """Number of messages buffered and not yet written."""
+        if self.spool is not None:
+            return self.spool.pending
+
+        return self._pending
+
+    def guild_depth(self, guild_id: int) -> int:
+        return len(self._buffers.get(guild_id, ()))
+
+    def start(self):
+        """Starts the background flusher. Safe to call more than once."""
+        if self._task is None or self._task.done():
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, guild_id: int, row: tuple):
+        """Buffers a single message row, waiting if the queue is full."""
+        if self._closed:
+            raise RuntimeError("IngestQueue is closed")
+
+        if self.spool is not None:
+            if self.spool.pending >= self.max_spooled:
+                log.warning(f"Ingest: spool full ({self.spool.pending} messages), waiting for the database")
+                while self.spool.pending >= self.max_spooled:
+                    self._has_space.clear()
+                    await self._has_space.wait()
+
+            self.spool.append([guild_id, row])
+            self._spooled.setdefault(guild_id, {})[row[0]] = row
+
+            if self.spool.pending >= self.batch_size:
+                self._wakeup.set()
+            return
+
+        if self._pending >= self.max_pending:
+            log.warning(f"Ingest: queue full ({self._pending} messages), waiting for the database")
+            while self._pending >= self.max_pending:
+                await self._has_space.wait()
+
+        buffer = self._buffers.setdefault(guild_id, [])
+        if not buffer:
+            self._oldest[guild_id] = time.monotonic()
+
+        buffer.append(row)
+        self._pending += 1
+
+        if self._pending >= self.max_pending:
+            self._has_space.clear()
+
+        if len(buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self, guild_id: int = None, message_id: int = None):
+        """Writes out the buffers of every guild, or of a single guild, regardless of their age.
+
+        With a spool, everything in it is written regardless of `guild_id`, but for the guilds being moved other than
+        `guild_id`. With a `message_id` too, only that message is written, if it's still buffered or spooled, e.g.
+        before it's edited. Returns once the rows buffered when it was called are written, or failed to be.
+        """
+        if self.spool is not None:
+            if message_id is not None and not self._backlog:
+                await self._write_spooled(guild_id, message_id)
+            elif self.spool.pending:
+                await self._drain(wait_for=guild_id)
+            return
+
+        if message_id is not None and all(row[0] != message_id for row in self._buffers.get(guild_id, ())):
+            # it may be in the batch being written
+            async with self._locks.setdefault(guild_id, asyncio.Lock()):
+                return
+
+        guild_ids = [guild_id] if guild_id is not None else list(self._buffers)
+        await asyncio.gather(*[self._flush_guild(i) for i in guild_ids])
+
+    async def _write_spooled(self, guild_id: int, message_id: int):
+        row = self._spooled.get(guild_id, {}).get(message_id)
+        if row is None:
+            return
+
+        # written ahead of the rest of the spool, `add_messages` skips it when the spool gets to it
+        try:
+            await self.db.add_messages(guild_id, [row])
+        except Exception as e:
+            log.error(f"Ingest: error while writing message {message_id} of guild {guild_id}: {e}")
+            return
+
+        self._spooled.get(guild_id, {}).pop(message_id, None)
+
+    async def close(self):
+        """Stops the background flusher and writes out everything still buffered."""
+        self._closed = True
+
+        # let the flusher finish the batch it's writing instead of cancelling it half way through
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+
+        ingest_queue_depth.remove_function(self._get_depth)
+
+        if self.spool is not None:
+            if self.spool.pending:
+                log.warning(f"Ingest: {self.spool.pending} messages left in the spool, they are written on the next start")
+
+            self.spool.close()
+
+        elif self._pending:
+            log.error(f"Ingest: {self._pending} messages could not be written on shutdown")
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_delay / 2)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self.spool is not None:
+                if not await self._drain():
+                    # don't retry on every new message while the database is down
+                    await asyncio.sleep(self.max_delay)
+                continue
+
+            now = time.monotonic()
+            due = [
+                guild_id for guild_id, buffer in self._buffers.items()
+                if len(buffer) >= self.batch_size or (buffer and now - self._oldest[guild_id] >= self.max_delay)
+            ]
+
+            # writing them would wait for the move to finish, holding up the other guilds
+            due = [guild_id for guild_id in due if not await self.db.is_frozen(guild_id)]
+
+            if due:
+                await asyncio.gather(*[self._flush_guild(guild_id) for guild_id in due])
+
+    async def _flush_guild(self, guild_id: int):
+        async with self._locks.setdefault(guild_id, asyncio.Lock()):
+            await self._write_guild(guild_id)
+
+    async def _write_guild(self, guild_id: int):
+        rows = self._buffers.pop(guild_id, None)
+        self._oldest.pop(guild_id, None)
+
+        if not rows:
+            return
+
+        start_time = time.monotonic()
+
+        try:
+            for i in range(0, len(rows), self.batch_size):
+                with ingest_flush_seconds.time():
+                    await self.db.add_messages(guild_id, rows[i:i + self.batch_size])
+
+                messages_ingested.inc(min(self.batch_size, len(rows) - i), guild_id=guild_id)
+                # release each batch as soon as it's written so a later failure doesn't re-write it
+                self._pending -= min(self.batch_size, len(rows) - i)
+
+        except Exception as e:
+            # put the unwritten rows back in front of anything buffered meanwhile, they are retried on the next tick
+            rows = rows[i:]
+            log.error(f"Ingest: error while writing {len(rows)} messages for guild {guild_id}: {e}")
+
+            self._buffers[guild_id] = rows + self._buffers.get(guild_id, [])
+            self._oldest[guild_id] = start_time
+            return
+
+        finally:
+            if self._pending < self.max_pending:
+                self._has_space.set()
+
+        log.debug(
+            f"Ingest: wrote {len(rows)} messages for guild {guild_id} in "
+            f"{round((time.monotonic() - start_time) * 1000, 2)}ms ({self._pending} still buffered)"
+        )
+
+    async def _drain(self, wait_for: int = None) -> bool:
+        """Writes the spool into the database until it's empty, stopping at the first failure.
+
+        The rows of the guilds being moved are spooled again, but for `wait_for`'s, which are written once its move
+        is done. Returns whether the spool was emptied.
+        """
+        # a read that isn't committed yet would be read and written again by a second drain
+        async with self._drain_lock:
+            return await self._drain_spool(wait_for)
+
+    async def _drain_spool(self, wait_for: int = None) -> bool:
+        await asyncio.to_thread(self.spool.sync)
+
+        # once only the rows spooled again are left, they are for the next drain
+        respooled = 0
+
+        while self.spool.pending > respooled:
+            records, position = await asyncio.to_thread(self.spool.read, self.batch_size * 20)
+            if not records:
+                break
+
+            start_time = time.monotonic()
+
+            rows = {}
+            for guild_id, row in records:
+                rows.setdefault(guild_id, []).append(tuple(row))
+
+            try:
+                frozen = [i for i in rows if i != wait_for and await self.db.is_frozen(i)]
+
+                for guild_id, guild_rows in rows.items():
+                    if guild_id in frozen:
+                        continue
+
+                    for i in range(0, len(guild_rows), self.batch_size):
+                        with ingest_flush_seconds.time():
+                            await self.db.add_messages(guild_id, guild_rows[i:i + self.batch_size])
+
+            except Exception as e:
+                # nothing is committed, so the whole read is retried on the next tick. `add_messages` skips the
+                # rows that were written before the failure
+                log.error(f"Ingest: error while writing {len(records)} spooled messages: {e}")
+                return False
+
+            if frozen:
+                # appended before the read is committed, so they're never only in memory
+                for guild_id in frozen:
+                    for row in rows.pop(guild_id):
+                        self.spool.append([guild_id, row])
+                        respooled += 1
+
+                await asyncio.to_thread(self.spool.sync)
+
+            self.spool.commit(position, len(records))
+
+            if self.spool.pending < self.max_spooled:
+                self._has_space.set()
+
+            # counted once committed, the rows of a failed read are written again
+            for guild_id, guild_rows in rows.items():
+                messages_ingested.inc(len(guild_rows), guild_id=guild_id)
+
+                spooled = self._spooled.get(guild_id, {})
+                for row in guild_rows:
+                    spooled.pop(row[0], None)
+
+                if not spooled:
+                    self._spooled.pop(guild_id, None)
+
+            log.debug(
+                f"Ingest: wrote {sum(len(i) for i in rows.values())} spooled messages in "
+                f"{round((time.monotonic() - start_time) * 1000, 2)}ms ({self.spool.pending} still spooled)"
+            )
+
+        if respooled == 0:
+            self._backlog = False
+
+        return respooled == 0
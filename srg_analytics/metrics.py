@@ -0,0 +1,253 @@
+"""Prometheus metrics of the ingest and query hot paths, served over HTTP in the text exposition format."""
+
+import asyncio
+import functools
+import inspect
+import logging
+import time
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+# in seconds, from a fast indexed lookup to a slow full table scan
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class Registry:
+    """The metrics of the process, rendered together on every scrape."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.description)}")
+            lines.append(f"# TYPE {metric.name} {metric.type_}")
+
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type_ = None
+
+    def __init__(self, name: str, description: str, labels: tuple = (), registry: Registry = None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._values = {}
+        self._functions = []
+
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[i]) for i in self.labels)
+
+    def add_function(self, func):
+        """Adds `func`, called on every scrape for the current value, or {label values: value} with labels."""
+        self._functions.append(func)
+
+    def remove_function(self, func):
+        if func in self._functions:
+            self._functions.remove(func)
+
+    def samples(self):
+        values = dict(self._values)
+
+        for func in self._functions:
+            try:
+                res = func()
+            except Exception as e:
+                log.warning(f"Metrics: couldn't collect {self.name}: {e}")
+                continue
+
+            values.update(res if isinstance(res, dict) else {(): res})
+
+        for key, value in values.items():
+            yield "", dict(zip(self.labels, key)), value
+
+
+class Counter(_Metric):
+    type_ = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_ = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class _Timer:
+    def __init__(self, histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(_Metric):
+    type_ = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 registry: Registry = None):
+        super().__init__(name, description, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # the count of each bucket, then the sum and the count of every observation
+        state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+
+        state[-2] += value
+        state[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        """Times the body of a `with` block, awaits included."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, state in self._values.items():
+            labels = dict(zip(self.labels, key))
+
+            for bound, count in zip(self.buckets, state):
+                yield "_bucket", {**labels, "le": bound}, count
+
+            yield "_bucket", {**labels, "le": "+Inf"}, state[-1]
+            yield "_sum", labels, state[-2]
+            yield "_count", labels, state[-1]
+
+
+def timed_methods(histogram: Histogram):
+    """Class decorator that times every public coroutine method in `histogram`, labelled with the method's name."""
+    def wrap(name, func):
+        @functools.wraps(func)
+        async def timed(*args, **kwargs):
+            with histogram.time(method=name):
+                return await func(*args, **kwargs)
+
+        return timed
+
+    def decorate(cls):
+        for name, func in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.iscoroutinefunction(func):
+                setattr(cls, name, wrap(name, func))
+
+        return cls
+
+    return decorate
+
+
+messages_ingested = Counter(
+    "srg_messages_ingested_total", "Messages written to the database by the ingest queue.", ("guild_id",)
+)
+ingest_queue_depth = Gauge("srg_ingest_queue_depth", "Messages buffered or spooled and not yet written.")
+ingest_flush_seconds = Histogram("srg_ingest_flush_seconds", "Time taken to write a batch of buffered messages.")
+
+db_pool_connections = Gauge(
+    "srg_db_pool_connections", "Connections of each database pool, by state (used, free or max).", ("pool", "state")
+)
+db_method_seconds = Histogram("srg_db_method_seconds", "Time taken by each DB method, waits for a connection included.",
+                              ("method",))
+
+cache_requests = Counter(
+    "srg_cache_requests_total", "Cache lookups, by cache and result (hit or miss).", ("cache", "result")
+)
+
+chart_render_seconds = Histogram(
+    "srg_chart_render_seconds", "Time taken to draw a chart in a render worker.", ("chart",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+
+def _cache_stats() -> dict:
+    # imported here, the caches are only looked at when scraped
+    from srg_analytics.cache import chart_cache, query_cache
+    from srg_analytics.resolver import resolver
+
+    caches = {f"query:{name}": stats for name, stats in query_cache.stats().items()}
+    caches["charts"] = (chart_cache.hits, chart_cache.misses)
+    caches["names"] = (resolver._names.hits, resolver._names.misses)
+
+    values = {}
+    for cache, (hits, misses) in caches.items():
+        values[(cache, "hit")] = hits
+        values[(cache, "miss")] = misses
+
+    return values
+
+
+cache_requests.add_function(_cache_stats)
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+
+        # the headers aren't needed, but have to be read
+        while await asyncio.wait_for(reader.readline(), timeout=5) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request.split()
+
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/", b"/metrics"):
+            status, body = "200 OK", REGISTRY.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        log.debug(f"Metrics: dropped a scrape: {e}")
+
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = "127.0.0.1", port: int = 9464) -> asyncio.AbstractServer:
+    """Serves the metrics at http://host:port/metrics, close the returned server to stop."""
+    server = await asyncio.start_server(_handle, host, port)
+    log.info(f"Metrics: serving on http://{host}:{port}/metrics")
+
+    return server
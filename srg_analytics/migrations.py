@@ -0,0 +1,95 @@
+"""Versioned schema migrations for the per-guild message tables."""
+
+import asyncio
+import logging
+
+import aiomysql
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+# (version, description, statements), `{table}` is replaced with the guild's table.
+# Never edit a migration that has shipped, add a new one instead.
+MIGRATIONS = [
+    (1, "author, channel and time indexes", [
+        "ALTER TABLE {table} "
+        "ADD INDEX author_epoch (aliased_author_id, epoch), "
+        "ADD INDEX channel_epoch (channel_id, epoch), "
+        "ADD INDEX raw_author (author_id), "
+        "ALGORITHM=INPLACE, LOCK=NONE;",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# errors meaning a statement has already been applied, e.g. by a run that was interrupted before recording it
+_ALREADY_APPLIED = {
+    1060,  # duplicate column name
+    1061,  # duplicate key name
+    1091,  # can't drop, doesn't exist
+}
+
+
+async def migrate_table(db, guild_id: int, version: int = None) -> int:
+    """Brings a guild's table up to `SCHEMA_VERSION`, returning the number of migrations applied."""
+    if version is None:
+        version = await db.get_schema_version(guild_id)
+
+    applied = 0
+
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        for statement in statements:
+            try:
+                await db.execute(statement.format(table=f"`{guild_id}`"), guild_id=guild_id)
+            except aiomysql.MySQLError as e:
+                if e.args[0] not in _ALREADY_APPLIED:
+                    raise
+
+        await db.set_schema_version(guild_id, migration_version)
+        log.debug(f"Migrations: applied {migration_version} ({description}) to guild {guild_id}")
+        applied += 1
+
+    return applied
+
+
+async def migrate_all(db, concurrency: int = 2, pause: float = 1.0) -> dict:
+    """Brings every guild's table up to `SCHEMA_VERSION`.
+
+    At most `concurrency` tables are altered at once, and each worker waits `pause` seconds after altering a
+    table, so a run across thousands of tables doesn't starve ingest of I/O.
+
+    Returns {"migrated": int, "up_to_date": int, "failed": {guild_id: error}}.
+    """
+    versions = await db.get_schema_versions()
+    guild_ids = await db.get_guild_ids()
+
+    outdated = [i for i in guild_ids if versions.get(i, 0) < SCHEMA_VERSION]
+    result = {"migrated": 0, "up_to_date": len(guild_ids) - len(outdated), "failed": {}}
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(guild_id):
+        async with semaphore:
+            try:
+                await migrate_table(db, guild_id, versions.get(guild_id, 0))
+                result["migrated"] += 1
+            except Exception as e:
+                log.error(f"Migrations: failed to migrate guild {guild_id}: {e}")
+                result["failed"][guild_id] = e
+
+            await asyncio.sleep(pause)
+
+            done = result["migrated"] + len(result["failed"])
+            if done % 100 == 0:
+                log.info(f"Migrations: {done}/{len(outdated)} tables migrated")
+
+    await asyncio.gather(*[run(i) for i in outdated])
+
+    log.info(
+        f"Migrations: {result['migrated']} migrated, {result['up_to_date']} already up to date, "
+        f"{len(result['failed'])} failed"
+    )
+
+    return result
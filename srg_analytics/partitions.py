@@ -0,0 +1,120 @@
+"""Monthly RANGE partitioning of the per-guild message tables on message_id.
+
+Message IDs are snowflakes, so they grow with time and a month is a range of IDs. Queries that filter on a
+message_id range (see `helpers.message_id_range`) only read the partitions of the months in their window.
+Each table ends with an empty `pmax` partition that new months are split off from.
+"""
+
+import asyncio
+import datetime
+import logging
+
+from srg_analytics.helpers import epoch_to_snowflake, snowflake_to_epoch
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+
+def _next_month(year: int, month: int) -> tuple:
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _month_of(epoch: float) -> tuple:
+    date = datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc)
+    return date.year, date.month
+
+
+def _definition(year: int, month: int) -> str:
+    """The partition of a month, holding every message before the next month (and after the previous partition)."""
+    end = datetime.datetime(*_next_month(year, month), 1, tzinfo=datetime.timezone.utc).timestamp()
+    return f"PARTITION p{year:04d}{month:02d} VALUES LESS THAN ({epoch_to_snowflake(end)})"
+
+
+def _months(since: tuple, until: tuple) -> list:
+    months = []
+
+    while since <= until:
+        months.append(since)
+        since = _next_month(*since)
+
+    return months
+
+
+def _partition_by(since: float, months_ahead: int) -> str:
+    until = _month_of(datetime.datetime.now(datetime.timezone.utc).timestamp() + months_ahead * 31 * 86400)
+    definitions = [_definition(*i) for i in _months(_month_of(since), until)]
+
+    return f"PARTITION BY RANGE (message_id) ({', '.join(definitions)}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+
+
+async def get_partitions(db) -> dict:
+    """Returns {guild_id: [partition names in order]} of every partitioned guild table."""
+    res = await db.execute_on_shards(
+        "SELECT TABLE_NAME, PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND PARTITION_NAME IS NOT NULL ORDER BY TABLE_NAME, PARTITION_ORDINAL_POSITION;"
+    )
+
+    partitions = {}
+    for table, partition in res:
+        if str(table).isdigit():
+            partitions.setdefault(int(table), []).append(partition)
+
+    return partitions
+
+
+async def partition_table(db, guild_id: int, months_ahead: int = 3):
+    """Partitions a guild's table by month, from the month of its oldest message to `months_ahead` months ahead.
+
+    Instant on an empty table, otherwise the table is rebuilt, which takes as long as copying it.
+    """
+    oldest = (await db.execute(f"SELECT MIN(message_id) FROM `{guild_id}`;", fetch="one", guild_id=guild_id))[0]
+
+    # no message can be older than its guild
+    since = snowflake_to_epoch(oldest if oldest is not None else guild_id)
+
+    await db.execute(f"ALTER TABLE `{guild_id}` {_partition_by(since, months_ahead)};", guild_id=guild_id)
+
+
+async def extend_partitions(db, guild_id: int, partitions: list, months_ahead: int = 3) -> int:
+    """Splits partitions for the months up to `months_ahead` months ahead off the (empty) `pmax` partition.
+
+    Returns the number of partitions added.
+    """
+    months = [(int(i[1:5]), int(i[5:7])) for i in partitions if i != "pmax"]
+    until = _month_of(datetime.datetime.now(datetime.timezone.utc).timestamp() + months_ahead * 31 * 86400)
+
+    missing = _months(_next_month(*months[-1]), until) if months else []
+    if not missing:
+        return 0
+
+    definitions = [_definition(*i) for i in missing]
+    await db.execute(
+        f"ALTER TABLE `{guild_id}` REORGANIZE PARTITION pmax INTO "
+        f"({', '.join(definitions)}, PARTITION pmax VALUES LESS THAN MAXVALUE);",
+        guild_id=guild_id,
+    )
+
+    return len(missing)
+
+
+async def maintain_partitions(db, months_ahead: int = 3, pause: float = 1.0) -> int:
+    """Makes sure every partitioned guild table has partitions for the next `months_ahead` months.
+
+    Returns the number of partitions added.
+    """
+    added = 0
+
+    for guild_id, partitions in (await get_partitions(db)).items():
+        try:
+            count = await extend_partitions(db, guild_id, partitions, months_ahead)
+        except Exception as e:
+            log.error(f"Partitions: failed to extend the partitions of guild {guild_id}: {e}")
+            continue
+
+        if count:
+            added += count
+            await asyncio.sleep(pause)
+
+    if added:
+        log.info(f"Partitions: added {added} partitions")
+
+    return added
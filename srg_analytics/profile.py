@@ -1,57 +1,54 @@
+import copy
 import time
 from collections import Counter
 from typing import Tuple, Any
 
 from srg_analytics.DB import DB
+from srg_analytics.cache import query_cache
+from srg_analytics.helpers import messages_source
 from srg_analytics.schemas import Profile
 
 
-
-
-async def get_total_attachments(db: DB, guild_id: int, user_id: int) -> int:
-    """Returns the total number of attachments in a guild."""
-    return (
-        await db.execute(
-            # select sum of all values in sum_attachments column
-            f"SELECT SUM(num_attachments) FROM `{guild_id}` WHERE author_id = ?",
-            (str(user_id),), fetch="one"
-        )
-    )[0]
-
-
-async def get_total_embeds(db: DB, guild_id: int, user_id: int) -> int:
-    return (
-        await db.execute(
-            f"SELECT COUNT(has_embed) FROM `{guild_id}` WHERE author_id = ?",
-            (str(user_id),), fetch="one"
-        )
-    )[0]
-
-
-async def get_notnull_message_count(db: DB, guild_id: int, user_id: int):
-    return (
-        await db.execute(
-            f"SELECT count(*) FROM `{guild_id}` WHERE author_id = ? AND message_length IS NOT NULL AND message_length != ''",
-            (str(user_id),), fetch="one"
-        )
-    )[0]
-
-
-async def build_profile(db: DB, guild_id: int, user_id: int) -> dict:
+async def build_profile(db: DB, guild_id: int, user_id: int) -> Profile:
     """Builds the profile for a certain user, in a certain guild."""
     start_time = time.time()
 
-    return_dict = {
-        'user_id': user_id, 'guild_id': guild_id,
-        'messages': await db.get_message_count(guild_id=guild_id, user_id=user_id) or 0,
-        'characters': await db.get_character_count(guild_id=guild_id, user_id=user_id) or 0,
-        'total_embeds': await get_total_embeds(db, guild_id, user_id) or 0,
-        'total_attachments': await get_total_attachments(db, guild_id, user_id) or 0
-    }
-
-    return_dict['average_message_length'] = return_dict['characters'] / (await get_notnull_message_count(db, guild_id, user_id) or 1)
-    return_dict['time_taken'] = time.time() - start_time
-
-    print(return_dict)
-
-    return return_dict
+    profile = await query_cache.get_or_run(
+        db, guild_id, "profile", {"user_id": user_id}, lambda: _build_profile(db, guild_id, user_id),
+        historical=True,
+    )
+
+    # a copy, so the time taken reflects this call and the cached profile isn't changed
+    profile = copy.copy(profile)
+    profile.time_taken = time.time() - start_time
+
+    return profile
+
+
+async def _build_profile(db: DB, guild_id: int, user_id: int) -> Profile:
+
+    # every field in a single pass over the user's messages
+    messages, characters, total_embeds, total_attachments, notnull_messages = await db.execute(
+        f"""
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(message_length), 0),
+                COALESCE(SUM(has_embed), 0),
+                COALESCE(SUM(num_attachments), 0),
+                COALESCE(SUM(message_length IS NOT NULL AND message_length != 0), 0)
+            FROM {await messages_source(db, guild_id, read=True)}
+            WHERE author_id = ?
+        """, (user_id,), fetch="one", read=True, guild_id=guild_id
+    )
+
+    profile = Profile()
+    profile.user_id = user_id
+    profile.guild_id = guild_id
+
+    profile.messages = int(messages)
+    profile.characters = int(characters)
+    profile.total_embeds = int(total_embeds)
+    profile.total_attachments = int(total_attachments)
+    profile.average_message_length = profile.characters / (int(notnull_messages) or 1)
+
+    return profile
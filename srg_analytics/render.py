@@ -0,0 +1,138 @@
+"""Chart rendering in a pool of worker processes, so matplotlib never runs on the event loop."""
+
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from srg_analytics.metrics import chart_render_seconds
+
+
+def _init_worker():
+    # matplotlib and the cyberpunk style are imported once per worker instead of once per chart
+    import matplotlib
+    matplotlib.use("Agg")
+
+    import matplotlib.pyplot as plt
+    import mplcyberpunk  # noqa: F401, registers the "cyberpunk" style
+
+    plt.style.use("cyberpunk")
+
+
+def _noop():
+    return None
+
+
+def _to_png(fig, dpi: int) -> bytes:
+    import matplotlib.pyplot as plt
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=dpi)
+    plt.close(fig)
+
+    return buf.getvalue()
+
+
+def _pie(values: list, labels: list, title: str, dpi: int) -> bytes:
+    import matplotlib.pyplot as plt
+    import mplcyberpunk
+
+    fig, ax = plt.subplots()
+    pie, texts, autotexts = ax.pie(values, labels=labels, autopct="%1.1f%%")
+
+    for text in autotexts:
+        text.set_color('black')
+
+    for text in texts:
+        text.set_color('white')
+
+    ax.set_title(title)
+
+    mplcyberpunk.add_glow_effects(ax=ax)
+
+    return _to_png(fig, dpi)
+
+
+def _series(series: list, title: str, legend: bool, dpi: int) -> bytes:
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+    import mplcyberpunk
+
+    fig, ax = plt.subplots(figsize=(12, 6), dpi=120)
+
+    for label, dates, counts in series:
+        ax.plot(dates, counts, label=label, marker='o')
+
+    # Format x-axis labels properly
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+
+    plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Number of Messages')
+    ax.set_title(title)
+
+    if legend:
+        ax.legend()
+
+    mplcyberpunk.add_glow_effects(ax=ax)
+
+    fig.tight_layout()
+
+    return _to_png(fig, dpi)
+
+
+class RenderPool:
+    """Renders charts in worker processes and returns them as PNG bytes.
+
+    At most `max_concurrent` charts are rendered (or waiting for a worker) at once, further calls wait their turn.
+    """
+
+    def __init__(self, workers: int = 2, max_concurrent: int = 4):
+        self.workers = workers
+        self.max_concurrent = max_concurrent
+
+        self._executor = None
+        self._semaphore = None
+
+    def start(self, workers: int = None, max_concurrent: int = None):
+        """Starts the worker processes, importing matplotlib in each of them up front."""
+        if self._executor is not None:
+            return
+
+        self.workers = workers or self.workers
+        self.max_concurrent = max_concurrent or self.max_concurrent
+
+        # spawn instead of fork, forking a process that runs an event loop and a gateway connection isn't safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        for _ in range(self.workers):
+            self._executor.submit(_noop)
+
+    def shutdown(self):
+        if self._executor is None:
+            return
+
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    async def render(self, func, *args) -> bytes:
+        if self._executor is None:
+            self.start()
+
+        async with self._semaphore:
+            with chart_render_seconds.time(chart=func.__name__.lstrip("_")):
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def pie(self, values: list, labels: list, title: str, dpi: int = 600) -> bytes:
+        return await self.render(_pie, values, labels, title, dpi)
+
+    async def series(self, series: list, title: str, legend: bool = False, dpi: int = 300) -> bytes:
+        """Renders a line chart, `series` is a list of (label, dates, counts)."""
+        return await self.render(_series, series, title, legend, dpi)
+
+
+renderer = RenderPool()
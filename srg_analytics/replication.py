@@ -0,0 +1,185 @@
+"""Asynchronous replication of the writes to the primary database onto the offsite database."""
+
+import asyncio
+import logging
+import time
+
+import aiomysql
+
+from srg_analytics.DB import DB
+from srg_analytics.spool import Spool
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+# errors that mean the replica is unreachable rather than that the write itself is wrong
+_TRANSIENT = (aiomysql.OperationalError, OSError, asyncio.TimeoutError)
+
+
+class Replicator:
+    """Replays the writes made to the primary `DB` onto `replica`, in the order they were made.
+
+    The primary records each write with `record` after committing it, which only appends it to `spool`, so
+    replication never adds latency to the primary or loses writes while the replica is down. A background task
+    applies the spooled writes in batches, merging consecutive message inserts, and catches up on its own once the
+    replica is reachable again. Every write is idempotent on the replica, so writes replayed after a crash are
+    harmless.
+
+    Every `heartbeat_interval` seconds a heartbeat goes through the same stream and is stored on the replica as
+    the "replication:{name}" heartbeat, the time on the primary up to which the replica is known to be complete.
+    """
+
+    def __init__(self, replica: DB, spool: Spool, name: str, batch_size: int = 500, max_delay: float = 2.0,
+                 heartbeat_interval: float = 10.0):
+        self.replica = replica
+        self.spool = spool
+        self.name = name
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.heartbeat_interval = heartbeat_interval
+
+        self.applied_at = None
+
+        self._oldest = None
+        self._last_heartbeat = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+    @property
+    def lag(self) -> float:
+        """Seconds since the oldest write that hasn't been applied to the replica was made, 0 when caught up."""
+        if self._oldest is None:
+            return 0.0
+
+        return time.time() - self._oldest
+
+    @property
+    def pending(self) -> int:
+        return self.spool.pending
+
+    def record(self, op: str, *args):
+        """Queues a call of the `DB` method `op` with `args` to be made on the replica."""
+        self.spool.append([op, args, time.time()])
+
+        if self._oldest is None:
+            self._oldest = time.time()
+
+        if self.spool.pending >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Applies what it can of the spooled writes and stops, the rest is applied after the next start."""
+        self._closed = True
+
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        await self._drain()
+
+        if self.spool.pending:
+            log.warning(f"Replication: {self.spool.pending} writes left in the spool, they are applied on the next start")
+
+        self.spool.close()
+        await self.replica.close()
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if time.time() - self._last_heartbeat >= self.heartbeat_interval:
+                self._last_heartbeat = time.time()
+                self.record("heartbeat", self._last_heartbeat)
+
+            if not await self._drain():
+                # the replica is down, don't retry on every write
+                await asyncio.sleep(self.max_delay * 5)
+
+    async def _drain(self) -> bool:
+        """Applies the spool to the replica until it's empty, returning False if the replica is unreachable."""
+        try:
+            await self.replica.connect()
+        except Exception as e:
+            log.error(f"Replication: can't connect to the replica ({round(self.lag)}s behind): {e}")
+            return False
+
+        await asyncio.to_thread(self.spool.sync)
+
+        while True:
+            records, position = await asyncio.to_thread(self.spool.read, self.batch_size * 20)
+            if not records:
+                self._oldest = None
+                return True
+
+            self._oldest = records[0][2]
+
+            try:
+                await self._apply(records)
+
+            except _TRANSIENT as e:
+                log.error(f"Replication: the replica is unreachable ({round(self.lag)}s behind): {e}")
+                return False
+
+            except Exception as e:
+                # find and skip the writes that can never be applied, instead of retrying them forever
+                log.error(f"Replication: error while applying {len(records)} writes, retrying one by one: {e}")
+
+                for record in records:
+                    try:
+                        await self._apply([record])
+                    except _TRANSIENT as e:
+                        log.error(f"Replication: the replica is unreachable ({round(self.lag)}s behind): {e}")
+                        return False
+                    except Exception as e:
+                        log.error(f"Replication: skipping {record[0]}{tuple(record[1])[:2]}: {e}")
+
+            self.spool.commit(position, len(records))
+            self.applied_at = records[-1][2]
+
+    async def _apply(self, records: list):
+        i = 0
+
+        while i < len(records):
+            op, args, _ = records[i]
+            i += 1
+
+            if op == "heartbeat":
+                await self.replica.set_heartbeat(f"replication:{self.name}", args[0])
+
+            elif op == "add_messages":
+                # consecutive inserts into the same guild are applied together
+                guild_id, rows = args[0], [tuple(row) for row in args[1]]
+
+                while i < len(records) and records[i][0] == "add_messages" and records[i][1][0] == guild_id:
+                    rows.extend(tuple(row) for row in records[i][1][1])
+                    i += 1
+
+                for j in range(0, len(rows), self.batch_size):
+                    await self._call("add_messages", guild_id, rows[j:j + self.batch_size])
+
+            elif op == "add_messages_bulk":
+                await self._call(op, args[0], [tuple(row) for row in args[1]], *args[2:])
+
+            else:
+                await self._call(op, *args)
+
+    async def _call(self, op: str, guild_id, *args):
+        try:
+            await getattr(self.replica, op)(guild_id, *args)
+        except aiomysql.ProgrammingError as e:
+            # the guild was added before replication was turned on, so the replica only gets its messages from now on
+            if e.args[0] != 1146 or op in ("add_guild", "remove_guild"):
+                raise
+
+            await self.replica.add_guild(guild_id, complete=False)
+            await getattr(self.replica, op)(guild_id, *args)
@@ -0,0 +1,126 @@
+"""Resolving member and channel IDs to display names for leaderboards."""
+
+import asyncio
+
+import discord
+
+from srg_analytics.cache import LRUCache
+
+_MISSING = object()
+
+
+class NameResolver:
+    """Resolves IDs to names, trying the gateway cache first and then the API, with every miss fetched at once.
+
+    Names are kept for `ttl` seconds. IDs that can't be resolved (deleted users, members who left, deleted
+    channels) are remembered as None for `negative_ttl` seconds so they aren't requested again every time.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600, negative_ttl: float = 3600):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._names = LRUCache(maxsize=maxsize)
+
+    def _store(self, key, name):
+        self._names.set(key, name, ttl=self.ttl if name is not None else self.negative_ttl)
+
+    async def member_names(self, guild, user_ids: list) -> dict:
+        """Returns {user_id: nickname or display name}, with None for members that couldn't be found."""
+        names = {}
+        missing = []
+
+        for user_id in dict.fromkeys(user_ids):
+            name = self._names.get(("member", guild.id, user_id), _MISSING)
+            if name is not _MISSING:
+                names[user_id] = name
+                continue
+
+            member = guild.get_member(user_id)
+            if member is not None:
+                names[user_id] = member.nick or member.display_name
+                self._store(("member", guild.id, user_id), names[user_id])
+                continue
+
+            missing.append(user_id)
+
+        if missing:
+            for user_id, name in (await self._fetch_members(guild, missing)).items():
+                names[user_id] = name
+                if name is not _MISSING:
+                    self._store(("member", guild.id, user_id), name)
+
+        return {user_id: (None if name is _MISSING else name) for user_id, name in names.items()}
+
+    async def channel_names(self, guild, channel_ids: list) -> dict:
+        """Returns {channel_id: channel name}, with None for channels that couldn't be found."""
+        names = {}
+        missing = []
+
+        for channel_id in dict.fromkeys(channel_ids):
+            name = self._names.get(("channel", guild.id, channel_id), _MISSING)
+            if name is not _MISSING:
+                names[channel_id] = name
+                continue
+
+            channel = guild.get_channel_or_thread(channel_id) if hasattr(guild, "get_channel_or_thread") else None
+            if channel is not None:
+                names[channel_id] = channel.name
+                self._store(("channel", guild.id, channel_id), channel.name)
+                continue
+
+            missing.append(channel_id)
+
+        results = await asyncio.gather(*[guild.fetch_channel(i) for i in missing], return_exceptions=True)
+
+        for channel_id, result in zip(missing, results):
+            if isinstance(result, (discord.NotFound, discord.Forbidden)):
+                names[channel_id] = None
+            elif isinstance(result, Exception):
+                # a temporary failure, don't remember it
+                names[channel_id] = None
+                continue
+            else:
+                names[channel_id] = result.name
+
+            self._store(("channel", guild.id, channel_id), names[channel_id])
+
+        return names
+
+    async def _fetch_members(self, guild, user_ids: list) -> dict:
+        names = {}
+
+        try:
+            # one gateway request per 100 IDs instead of one REST call per member
+            chunks = [user_ids[i:i + 100] for i in range(0, len(user_ids), 100)]
+            results = await asyncio.gather(
+                *[guild.query_members(user_ids=chunk, limit=len(chunk), cache=True) for chunk in chunks]
+            )
+
+            for members in results:
+                for member in members:
+                    names[member.id] = member.nick or member.display_name
+
+            for user_id in user_ids:
+                names.setdefault(user_id, None)
+
+            return names
+
+        except Exception:
+            # e.g. a guild object from fetch_guild, which has no gateway connection to query through
+            pass
+
+        results = await asyncio.gather(*[guild.fetch_member(i) for i in user_ids], return_exceptions=True)
+
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, (discord.NotFound, discord.Forbidden)):
+                names[user_id] = None
+            elif isinstance(result, Exception):
+                names[user_id] = _MISSING
+            else:
+                names[user_id] = result.nick or result.display_name
+
+        return names
+
+
+resolver = NameResolver()
@@ -6,6 +6,10 @@ class Profile:
 
         # Message data
         self.messages = None
+        self.characters = None
+        self.average_message_length = None
+        self.total_embeds = None
+        self.total_attachments = None
         self.top_words = []
         self.top_emojis = []
 
@@ -25,3 +29,6 @@ class Profile:
         self.most_active_hour = None
         self.most_active_day = None
 
+        # how long building the profile took, in seconds
+        self.time_taken = None
+
@@ -0,0 +1,284 @@
+"""Spreading the guilds over several MySQL backends, and moving guilds between them.
+
+Every guild lives on one backend, with its message tables and its rows of the tables keyed by guild (`GUILD_TABLES`).
+The rest (timezones, heartbeats, deletion jobs, the shard map itself...) stays on the primary backend.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+
+from srg_analytics.DB import MESSAGE_COLUMNS, MESSAGE_PLACEHOLDER
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+# the tables whose rows of a guild are stored on the guild's backend, and moved with it
+GUILD_TABLES = (
+    "rollup_hourly", "rollup_ready", "guild_versions", "schema_versions", "archive_state", "harvest_progress", "aliases",
+)
+
+# a move whose mover hasn't been heard from for this many seconds is considered dead, and stops holding up writes
+FREEZE_TIMEOUT = 60
+
+
+def _hash(key: str) -> int:
+    # not `hash()`, which differs between processes
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class ShardMap:
+    """Maps guilds to backends with consistent hashing, except the guilds in `overrides`.
+
+    Every backend gets `vnodes` points on a hash ring, and a guild belongs to the first point after its own hash.
+    Adding a backend only takes over the ring between its points and the ones before them, about 1/N of it.
+
+    `overrides` is {guild_id: (shard, target, moving_since)}, loaded from the `shard_map` table. It pins the guilds
+    that aren't where the ring puts them, and `target` is set while a guild is being moved there.
+    """
+
+    def __init__(self, names: list, vnodes: int = 160):
+        self.names = list(names)
+
+        ring = sorted((_hash(f"{name}#{i}"), name) for name in self.names for i in range(vnodes))
+        self._points = [i[0] for i in ring]
+        self._owners = [i[1] for i in ring]
+
+        self.overrides = {}
+
+    def ring_shard(self, guild_id: int) -> str:
+        """The backend the ring puts a guild on."""
+        i = bisect.bisect(self._points, _hash(str(guild_id))) % len(self._points)
+        return self._owners[i]
+
+    def locate(self, guild_id: int) -> tuple:
+        """Returns (backend, frozen), frozen meaning writes have to wait for a move to finish."""
+        if guild_id not in self.overrides:
+            return self.ring_shard(guild_id), False
+
+        shard, target, moving_since = self.overrides[guild_id]
+        frozen = target is not None and time.time() - moving_since < FREEZE_TIMEOUT
+
+        return shard, frozen
+
+
+async def get_shard_counts(db) -> dict:
+    """Returns {backend: number of guilds on it}."""
+    counts = {name: 0 for name in db.pools}
+
+    for name, pool in db.pools.items():
+        tables = await db._execute(pool, "SHOW TABLES;", fetch="all")
+        counts[name] = len([i for i in tables if str(i[0]).isdigit()])
+
+    return counts
+
+
+async def _create_like(source, target, table: str):
+    """Creates `table` on the target backend as it is on the source, with its indexes and partitions."""
+    async with source.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(f"SHOW CREATE TABLE `{table}`;")
+            statement = (await cur.fetchone())[1]
+
+    async with target.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(statement.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+
+
+async def _sync_table(source, target, table: str, chunk_size: int, on_chunk=None) -> int:
+    """Makes the target's copy of a message table match the source, returning the number of rows copied.
+
+    The table is compared in ranges of `chunk_size` message IDs by checksum, and only the ranges that differ are
+    copied, so the first run copies everything and later runs only what changed since. `on_chunk` is awaited after
+    every range.
+    """
+    columns = ", ".join(MESSAGE_COLUMNS)
+    # NULLs are replaced, CONCAT_WS would skip them and shift the other values
+    values = ", ".join(f"IFNULL({i}, '')" for i in MESSAGE_COLUMNS)
+    checksum = (
+        f"SELECT COUNT(*), COALESCE(BIT_XOR(CRC32(CONCAT_WS(',', {values}))), 0) "
+        f"FROM `{table}` WHERE message_id > %s AND message_id <= %s;"
+    )
+
+    copied = 0
+    lower = -1
+
+    async with source.acquire() as source_conn, target.acquire() as target_conn:
+        async with source_conn.cursor() as source_cur, target_conn.cursor() as target_cur:
+            while True:
+                await source_cur.execute(
+                    f"SELECT message_id FROM `{table}` WHERE message_id > %s ORDER BY message_id LIMIT 1 OFFSET %s;",
+                    (lower, chunk_size - 1),
+                )
+                res = await source_cur.fetchone()
+                # the last range is open ended, so messages the source no longer has are removed from the target
+                upper = res[0] if res is not None else 2 ** 63 - 1
+
+                await source_cur.execute(checksum, (lower, upper))
+                expected = await source_cur.fetchone()
+                await target_cur.execute(checksum, (lower, upper))
+
+                if await target_cur.fetchone() != expected:
+                    await source_cur.execute(
+                        f"SELECT {columns} FROM `{table}` WHERE message_id > %s AND message_id <= %s;", (lower, upper)
+                    )
+                    rows = await source_cur.fetchall()
+
+                    await target_conn.begin()
+                    try:
+                        await target_cur.execute(
+                            f"DELETE FROM `{table}` WHERE message_id > %s AND message_id <= %s;", (lower, upper)
+                        )
+                        if rows:
+                            await target_cur.execute(
+                                f"INSERT INTO `{table}` ({columns}) VALUES {', '.join([MESSAGE_PLACEHOLDER] * len(rows))};",
+                                [value for row in rows for value in row],
+                            )
+                        await target_conn.commit()
+                    except Exception:
+                        await target_conn.rollback()
+                        raise
+
+                    copied += len(rows)
+
+                if on_chunk is not None:
+                    await on_chunk()
+
+                if res is None:
+                    return copied
+
+                lower = upper
+
+
+async def _copy_guild_rows(source, target, guild_id: int, batch_size: int = 1000):
+    """Replaces the guild's rows of `GUILD_TABLES` on the target with the ones on the source."""
+    async with source.acquire() as source_conn, target.acquire() as target_conn:
+        async with source_conn.cursor() as source_cur, target_conn.cursor() as target_cur:
+            await target_conn.begin()
+            try:
+                for table in GUILD_TABLES:
+                    await target_cur.execute(f"DELETE FROM {table} WHERE guild_id = %s;", (guild_id,))
+                    await source_cur.execute(f"SELECT * FROM {table} WHERE guild_id = %s;", (guild_id,))
+
+                    while rows := await source_cur.fetchmany(batch_size):
+                        placeholder = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+                        await target_cur.execute(
+                            f"INSERT INTO {table} VALUES {', '.join([placeholder] * len(rows))};",
+                            [value for row in rows for value in row],
+                        )
+
+                # cached results were keyed by the versions on the source
+                await target_cur.execute(
+                    "INSERT INTO guild_versions (guild_id, version) VALUES (%s, 1) "
+                    "ON DUPLICATE KEY UPDATE version = version + 1;",
+                    (guild_id,),
+                )
+
+                await target_conn.commit()
+            except Exception:
+                await target_conn.rollback()
+                raise
+
+
+async def _drop_guild(pool, guild_id: int):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(f"DROP TABLE IF EXISTS `{guild_id}`;")
+            await cur.execute(f"DROP TABLE IF EXISTS `{guild_id}_archive`;")
+
+            for table in GUILD_TABLES:
+                await cur.execute(f"DELETE FROM {table} WHERE guild_id = %s;", (guild_id,))
+
+
+async def move_guild(db, guild_id: int, target: str, chunk_size: int = 10000) -> int:
+    """Moves a guild to the `target` backend, returning the number of message rows copied.
+
+    The tables are copied while the guild is in use, then writes to the guild are held up (see `ShardMap.locate`)
+    while what changed during the copy is synced, and the guild is switched to the target. The move is also marked
+    in the source's `shard_map`, which waits for the writes already under way (see `DB._check_moving`). The switch is seen by
+    every process within `db.shard_refresh` seconds, only then are the source's copies dropped.
+
+    Safe to run again after a failure, the ranges that were already copied are skipped.
+    """
+    if db.shard_map is None:
+        raise ValueError("sharding isn't enabled")
+    if target not in db.pools:
+        raise ValueError(f"unknown backend {target}")
+
+    await db.load_shard_map()
+    source, _ = db.shard_map.locate(guild_id)
+
+    if source == target:
+        return 0
+
+    source_pool, target_pool = db.pools[source], db.pools[target]
+
+    tables = [str(guild_id)]
+    if (await db._execute(source_pool, "SELECT 1 FROM archive_state WHERE guild_id = %s;", (guild_id,), "one")) is not None:
+        tables.append(f"{guild_id}_archive")
+
+    log.info(f"Shards: moving guild {guild_id} from {source} to {target}")
+
+    # the bulk of the copy, while the guild is still written to
+    copied = 0
+    for table in tables:
+        await _create_like(source_pool, target_pool, table)
+        copied += await _sync_table(source_pool, target_pool, table, chunk_size)
+
+    # the primary's row is the shard map, the source's is only checked by the writers on it
+    marked = [db.con] if source_pool is db.con else [db.con, source_pool]
+
+    async def set_moving(pools=marked):
+        # also tells the writers that the mover is still alive
+        for pool in pools:
+            await db._execute(
+                pool,
+                "INSERT INTO shard_map (guild_id, shard, target, moving_since) VALUES (%s, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE shard = VALUES(shard), target = VALUES(target), "
+                "moving_since = VALUES(moving_since);",
+                (guild_id, source, target, time.time()),
+            )
+
+    async def unmark_source():
+        if source_pool is not db.con:
+            await db._execute(source_pool, "DELETE FROM shard_map WHERE guild_id = %s;", (guild_id,))
+
+    # returns once the transactions that write to the guild on the source are committed, the later ones see the mark
+    await set_moving()
+
+    try:
+        # the writes made outside of a transaction, e.g. bulk loads, are only held up once the freeze is seen
+        await asyncio.sleep(db.shard_refresh + 2)
+
+        for table in tables:
+            copied += await _sync_table(source_pool, target_pool, table, chunk_size, on_chunk=set_moving)
+
+        await _copy_guild_rows(source_pool, target_pool, guild_id)
+
+    except Exception:
+        await db.execute("UPDATE shard_map SET target = NULL, moving_since = NULL WHERE guild_id = ?;", (guild_id,))
+        await unmark_source()
+        raise
+
+    # the switch, the guild is only pinned if the ring puts it elsewhere
+    if db.shard_map.ring_shard(guild_id) == target:
+        await db.execute("DELETE FROM shard_map WHERE guild_id = ?;", (guild_id,))
+    else:
+        await db.execute(
+            "UPDATE shard_map SET shard = ?, target = NULL, moving_since = NULL WHERE guild_id = ?;", (target, guild_id)
+        )
+    await db.load_shard_map()
+
+    # the writers that haven't seen the switch yet keep being sent back by the source's mark until they do
+    if source_pool is not db.con:
+        await set_moving([source_pool])
+
+    # reads started on the source before the switch are given time to finish
+    await asyncio.sleep(db.shard_refresh + 2)
+    await _drop_guild(source_pool, guild_id)
+    await unmark_source()
+
+    log.info(f"Shards: moved guild {guild_id} from {source} to {target}, {copied} messages copied")
+
+    return copied
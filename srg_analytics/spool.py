@@ -0,0 +1,160 @@
+"""A durable, append-only local log that absorbs writes while the database is slow or unavailable."""
+
+import json
+import logging
+import os
+
+log = logging.getLogger("my-discord-bot.srg_analytics")
+
+
+class Spool:
+    """Append-only log of JSON records, split into numbered segment files in `directory`.
+
+    Records are appended to the newest segment, a new segment is started once it reaches `segment_size` bytes
+    and on every open, so a line torn by a crash is never appended to. The position up to which records have been
+    consumed is kept in an offset file that is replaced atomically, and segments before it are deleted.
+
+    Reading always starts at the committed position, so records read but not committed before a crash are read
+    again, consumers have to be idempotent.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._offset_path = os.path.join(directory, "offset")
+        self._committed = self._load_offset()
+
+        segments = self._segments()
+        self._segment = max(segments[-1] if segments else 0, self._committed[0]) + 1
+        self._file = open(self._segment_path(self._segment), "ab")
+        self._size = 0
+
+        self._pending = self._count_backlog()
+
+        if self._pending:
+            log.info(f"Spool: {self._pending} records left in {directory} from the last run")
+
+    @property
+    def pending(self) -> int:
+        """Number of records appended and not yet committed."""
+        return self._pending
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}.log")
+
+    def _segments(self) -> list:
+        return sorted(int(i[:-4]) for i in os.listdir(self.directory) if i.endswith(".log"))
+
+    def _load_offset(self) -> tuple:
+        try:
+            with open(self._offset_path) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except FileNotFoundError:
+            return 0, 0
+
+    def _count_backlog(self) -> int:
+        count = 0
+
+        for segment in self._segments():
+            if segment < self._committed[0] or segment == self._segment:
+                continue
+
+            with open(self._segment_path(segment), "rb") as f:
+                if segment == self._committed[0]:
+                    f.seek(self._committed[1])
+
+                while chunk := f.read(1024 * 1024):
+                    count += chunk.count(b"\n")
+
+        return count
+
+    def append(self, record):
+        """Appends a record, it's in the OS' page cache when this returns and on disk after the next `sync`."""
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+        self._file.write(line)
+        self._file.flush()
+
+        self._size += len(line)
+        self._pending += 1
+
+        if self._size >= self.segment_size:
+            self._file.close()
+            self._segment += 1
+            self._file = open(self._segment_path(self._segment), "ab")
+            self._size = 0
+
+    def sync(self):
+        """Forces every appended record to disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def read(self, max_records: int) -> tuple:
+        """Returns (records, position) of up to `max_records` records after the committed position.
+
+        Pass the position to `commit` once the records have been handled. Doesn't touch the appending side, so it
+        can run in a thread.
+        """
+        records = []
+        segment, offset = self._committed
+        current = self._segment
+
+        while len(records) < max_records:
+            try:
+                f = open(self._segment_path(segment), "rb")
+            except FileNotFoundError:
+                if segment >= current:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+
+            with f:
+                f.seek(offset)
+
+                while len(records) < max_records:
+                    line = f.readline()
+
+                    if not line.endswith(b"\n"):
+                        # the end of the segment, or a line that's still being written
+                        break
+
+                    offset += len(line)
+                    records.append(json.loads(line))
+
+                else:
+                    break
+
+            if segment >= current:
+                break
+
+            # a finished segment, a torn line at its end (from a crash) is skipped
+            segment, offset = segment + 1, 0
+
+        return records, (segment, offset)
+
+    def commit(self, position: tuple, count: int):
+        """Marks every record before `position`, `count` records since the last commit, as consumed."""
+        tmp_path = self._offset_path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            f.write(f"{position[0]} {position[1]}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self._offset_path)
+
+        self._committed = position
+        self._pending = max(self._pending - count, 0)
+
+        for segment in self._segments():
+            if segment >= position[0]:
+                break
+            os.remove(self._segment_path(segment))
+
+    def close(self):
+        self.sync()
+        self._file.close()
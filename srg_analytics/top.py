@@ -1,15 +1,26 @@
 import datetime
-import random
-
-import matplotlib.pyplot as plt
-import mplcyberpunk
-from collections import Counter
+import time
 
 from srg_analytics.DB import DB
+from srg_analytics.cache import chart_cache, query_cache
+from srg_analytics.helpers import message_id_range, messages_source
+from srg_analytics.render import renderer
+from srg_analytics.resolver import resolver
 
 
 async def get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, timeperiod: str = None,
                         count_others: bool = True):
+    # all time results only change when the guild is written to, the other windows move with the clock
+    return await query_cache.get_or_run(
+        db, guild_id, "top_users",
+        {"type_": type_, "amount": amount, "timeperiod": timeperiod, "count_others": count_others},
+        lambda: _get_top_users(db, guild_id, type_, amount, timeperiod, count_others),
+        historical=timeperiod is None,
+    )
+
+
+async def _get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, timeperiod: str = None,
+                         count_others: bool = True):
     # type_ can be either "messages" or "words" or "characters"
     # time_duration can be either "day" or "week" or "month" or "year" or None
 
@@ -38,24 +49,39 @@ async def get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, tim
     else:
         epoch_start = None
 
+    # the hourly rollups can answer every window that starts on the hour, which is all of them but "week"
+    if timeperiod != "week" and await db.rollups_ready(guild_id, read=True):
+        source, condition = "rollup_hourly", f"guild_id = {guild_id}"
+        author = "aliased_author_id"
+        counts = {"messages": "SUM(messages)", "characters": "SUM(characters)"}
+        window = f"AND hour >= {int(epoch_start.timestamp())}" if epoch_start is not None else ""
+    else:
+        source = await messages_source(
+            db, guild_id, epoch_start.timestamp() if epoch_start is not None else None, read=True
+        )
+        # counted like the rollups, messages stored without an alias under their author
+        condition = "TRUE"
+        author = "COALESCE(aliased_author_id, author_id)"
+        counts = {"messages": "COUNT(*)", "characters": "SUM(message_length)"}
+        window = f"AND {message_id_range(epoch_start.timestamp())}" if epoch_start is not None else ""
+
     if type_ == "messages":
         query = f"""
-                SELECT aliased_author_id, COUNT(aliased_author_id) AS count
-                FROM `{guild_id}`
-                WHERE is_bot = 0
+                SELECT {author} AS author, {counts['messages']} AS count
+                FROM {source}
+                WHERE {condition}
             """
-        if epoch_start is not None:
-            query += f"AND epoch >= {epoch_start.timestamp()}"
+        query += window
 
         query += """
-                GROUP BY aliased_author_id
+                GROUP BY author
                 ORDER BY count DESC
                 """
 
         if not count_others:
             query += f"LIMIT {amount}"
 
-        top = await db.execute(query, fetch="all")
+        top = await db.execute(query, fetch="all", read=True, guild_id=guild_id)
 
         if count_others:
             return [*top[:amount], ('others', sum([i[1] for i in top[amount:]]))]
@@ -65,53 +91,48 @@ async def get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, tim
 
     elif type_ == "characters":
         query = f"""
-                SELECT aliased_author_id, SUM(CHAR_LENGTH(message_content)) AS count
-                FROM `{guild_id}`
-                WHERE is_bot = 0
+                SELECT {author} AS author, {counts['characters']} AS count
+                FROM {source}
+                WHERE {condition}
             """
 
-        if timeperiod is not None:
-            query += f"AND epoch >= {epoch_start.timestamp()}"
+        query += window
 
         query += """
-                GROUP BY aliased_author_id
+                GROUP BY author
                 ORDER BY count DESC
                 """
 
-        top = await db.execute(query, fetch="all")
+        top = await db.execute(query, fetch="all", read=True, guild_id=guild_id)
 
         return top[:amount]
 
 
-async def get_top_users_visual(db: DB, guild_id: int, client, type_: str, timeperiod: str, amount: int = 10) -> str:
+async def get_top_users_visual(db: DB, guild_id: int, client, type_: str, timeperiod: str, amount: int = 10) -> bytes:
+    # the same chart for the same data is served from the cache, without querying or rendering again
+    key = (guild_id, "top_users", (type_, timeperiod, amount), await db.get_data_version(guild_id))
+    png = chart_cache.get(key)
+    if png is not None:
+        return png
+
     res = await get_top_users(db=db, guild_id=guild_id, type_=type_, timeperiod=timeperiod, amount=amount)
-    plt.style.use("cyberpunk")
 
-    # get member object from id and get their nickname, if not found, use "Deleted User"
+    # get the nickname of every member at once, if not found, use "Unknown"
+    guild = client.get_guild(guild_id) or await client.fetch_guild(guild_id)
+    names = await resolver.member_names(guild, [i[0] for i in res[:-1]])
+
     labels = []
-    guild = await client.fetch_guild(guild_id)
 
     for i in res:
         if i == res[-1]:
             labels.append(f"Others | {i[1]}")
             continue
-        try:
-            # get member
-            member = await guild.fetch_member(i[0])
-            # get nickname
-            labels.append(f"{member.nick or member.display_name} | {i[1]}")
 
-        except Exception:
+        if names.get(i[0]) is not None:
+            labels.append(f"{names[i[0]]} | {i[1]}")
+        else:
             labels.append(f"Unknown ({i[0]}) | {i[1]}")
 
-    pie, texts, autotexts = plt.pie([value for _, value in res], labels=labels, autopct="%1.1f%%")
-
-    for text in autotexts:
-        text.set_color('black')
-
-    for text in texts:
-        text.set_color('white')
-
     if timeperiod is None:
         timeperiod = "All Time"
     elif timeperiod == "day":
@@ -123,134 +144,172 @@ async def get_top_users_visual(db: DB, guild_id: int, client, type_: str, timepe
     elif timeperiod == "year":
         timeperiod = "this Year"
 
-    plt.title(f"Top {amount} Members by {type_.capitalize()} {timeperiod}")
+    png = await renderer.pie(
+        [value for _, value in res], labels, f"Top {amount} Members by {type_.capitalize()} {timeperiod}"
+    )
+    # windows that move with the clock go stale without any writes
+    chart_cache.set(key, png, ttl=None if key[2][1] is None else query_cache.ttl)
 
-    mplcyberpunk.add_glow_effects()
+    return png
 
-    # save image
-    name = f"{random.randint(1, 100000000)}.png"
-    try:
-        plt.savefig(name, format='png', dpi=600)
-    except Exception as e:
-        print(e)
 
-    plt.close()
+async def get_top_channels(db: DB, guild_id: int, type_: str, amount: int = 10):
+    return await query_cache.get_or_run(
+        db, guild_id, "top_channels", {"type_": type_, "amount": amount},
+        lambda: _get_top_channels(db, guild_id, type_, amount), historical=True,
+    )
 
-    return name
 
+async def _get_top_channels(db: DB, guild_id: int, type_: str, amount: int = 10):
+    if type_ in ["messages", "characters"] and await db.rollups_ready(guild_id, read=True):
+        return await db.execute(
+            f"""
+                SELECT channel_id, SUM({type_}) AS count
+                FROM rollup_hourly WHERE guild_id = {guild_id}
+                GROUP BY channel_id
+                ORDER BY count DESC
+                LIMIT {amount};
+            """, fetch="all", read=True, guild_id=guild_id
+        )
+
+    source = await messages_source(db, guild_id, read=True)
 
-async def get_top_channels(db: DB, guild_id: int, type_: str, amount: int = 10):
     if type_ == "messages":
         return await db.execute(
             f"""
-                SELECT channel_id, COUNT(aliased_author_id) AS count
-                FROM `{guild_id}` WHERE is_bot = 0
-                AND message_content IS NOT NULL
+                SELECT channel_id, COUNT(*) AS count
+                FROM {source}
                 GROUP BY channel_id
                 ORDER BY count DESC
                 LIMIT {amount};
-            """, fetch="all"
+            """, fetch="all", read=True, guild_id=guild_id
         )
 
     elif type_ == "characters":
-        # get all messages
-        res = await db.execute(
+        return await db.execute(
             f"""
-                        SELECT channel_id, message_content
-                        FROM `{guild_id}` WHERE is_bot = 0 AND message_content IS NOT NULL
-                    """, fetch="all"
+                SELECT channel_id, SUM(message_length) AS count
+                FROM {source}
+                GROUP BY channel_id
+                ORDER BY count DESC
+                LIMIT {amount};
+            """, fetch="all", read=True, guild_id=guild_id
         )
 
-        # Count characters for each user
-        char_counts = Counter()
-
-        for channel_id, message in res:
-            char_counts[channel_id] += len(message)
-
-        # Get the top users and their character counts
-        top_channels = char_counts.most_common()
 
-        return top_channels[:amount]
+async def get_top_channels_visual(db: DB, guild_id: int, client, type_: str, amount: int = 10) -> bytes:
+    key = (guild_id, "top_channels", (type_, amount), await db.get_data_version(guild_id))
+    png = chart_cache.get(key)
+    if png is not None:
+        return png
 
-
-async def get_top_channels_visual(db: DB, guild_id: int, client, type_: str, amount: int = 10) -> str:
     res = await get_top_channels(db=db, guild_id=guild_id, type_=type_, amount=amount)
-    plt.style.use("cyberpunk")
+
+    guild = client.get_guild(guild_id) or await client.fetch_guild(guild_id)
+    names = await resolver.channel_names(guild, [i[0] for i in res])
 
     labels = []
-    guild = await client.fetch_guild(guild_id)
 
     for i in res:
-        try:
-            channel = await guild.fetch_channel(i[0])
-
-            # get channel name
-            labels.append(f"{channel.name} | {i[1]}")
-
-        except Exception as e:
+        if names.get(i[0]) is not None:
+            labels.append(f"{names[i[0]]} | {i[1]}")
+        else:
             labels.append(f"Unknown Channel | {i[1]}")
 
-    pie, texts, autotexts = plt.pie([value for _, value in res], labels=labels, autopct="%1.1f%%")
-
-    for text in autotexts:
-        text.set_color('black')
+    png = await renderer.pie([value for _, value in res], labels, f"Top {amount} Channels by {type_}")
+    chart_cache.set(key, png)
 
-    for text in texts:
-        text.set_color('white')
+    return png
 
-    plt.title(f"Top {amount} Channels by {type_}")
 
-    mplcyberpunk.add_glow_effects()
-
-    # save image
-    name = f"{random.randint(1, 100000000)}.png"
-    try:
-        plt.savefig(name, format='png', dpi=600)
-    except Exception as e:
-        print(e)
-
-    plt.close()
+async def get_user_top_date(db: DB, guild_id: int, user_id: int, amount: int = 10):
+    return await query_cache.get_or_run(
+        db, guild_id, "user_top_date", {"user_id": user_id, "amount": amount},
+        lambda: _get_user_top_date(db, guild_id, user_id, amount), historical=True,
+    )
 
-    return name
 
+async def _get_user_top_date(db: DB, guild_id: int, user_id: int, amount: int = 10):
+    if await db.rollups_ready(guild_id, read=True):
+        return await db.execute(
+            f"""
+                SELECT
+                    UNIX_TIMESTAMP(CONCAT(DATE_FORMAT(FROM_UNIXTIME(hour), '%Y-%m-%d'), ' 00:00:00')) AS start_of_day_epoch,
+                    SUM(CASE WHEN aliased_author_id = {user_id} THEN messages ELSE 0 END) AS count,
+                    SUM(messages) AS total_count
+                FROM
+                    rollup_hourly
+                WHERE
+                    guild_id = {guild_id} AND hour <= UNIX_TIMESTAMP()
+                GROUP BY
+                    start_of_day_epoch
+                ORDER BY
+                    count DESC
+                LIMIT {amount};
+        """, fetch="all", read=True, guild_id=guild_id
+        )
 
-async def get_user_top_date(db: DB, guild_id: int, user_id: int, amount: int = 10):
     res = await db.execute(
         f"""
             SELECT
                 UNIX_TIMESTAMP(CONCAT(DATE_FORMAT(FROM_UNIXTIME(epoch), '%Y-%m-%d'), ' 00:00:00')) AS start_of_day_epoch,
-                COUNT(CASE WHEN aliased_author_id = {user_id} THEN 1 ELSE NULL END) AS count,
+                COUNT(CASE WHEN COALESCE(aliased_author_id, author_id) = {user_id} THEN 1 ELSE NULL END) AS count,
                 COUNT(*) AS total_count
             FROM
-                `{guild_id}`
+                {await messages_source(db, guild_id, read=True)}
             WHERE
-                epoch <= UNIX_TIMESTAMP()
+                {message_id_range(end_epoch=time.time())}
             GROUP BY
                 start_of_day_epoch
             ORDER BY
                 count DESC
             LIMIT {amount};
-    """, fetch="all"
+    """, fetch="all", read=True, guild_id=guild_id
     )
     return res
 
 
 async def get_server_top_date(db: DB, guild_id: int, amount: int = 10):
+    return await query_cache.get_or_run(
+        db, guild_id, "server_top_date", {"amount": amount},
+        lambda: _get_server_top_date(db, guild_id, amount), historical=True,
+    )
+
+
+async def _get_server_top_date(db: DB, guild_id: int, amount: int = 10):
+    if await db.rollups_ready(guild_id, read=True):
+        return await db.execute(
+            f"""
+        SELECT
+            UNIX_TIMESTAMP(CONCAT(DATE_FORMAT(FROM_UNIXTIME(hour), '%Y-%m-%d'), ' 00:00:00')) AS start_of_day_epoch,
+            SUM(messages) AS count
+        FROM
+            rollup_hourly
+        WHERE
+            guild_id = {guild_id} AND hour <= UNIX_TIMESTAMP()
+        GROUP BY
+            start_of_day_epoch
+        ORDER BY
+            count DESC
+        LIMIT {amount};
+        """, fetch="all", read=True, guild_id=guild_id
+        )
+
     res = await db.execute(
         f"""
     SELECT
         UNIX_TIMESTAMP(CONCAT(DATE_FORMAT(FROM_UNIXTIME(epoch), '%Y-%m-%d'), ' 00:00:00')) AS start_of_day_epoch,
         COUNT(*) AS count
     FROM
-        `{guild_id}`
+        {await messages_source(db, guild_id, read=True)}
     WHERE
-        epoch <= UNIX_TIMESTAMP()
+        {message_id_range(end_epoch=time.time())}
     GROUP BY
         start_of_day_epoch
     ORDER BY
         count DESC
     LIMIT {amount};
-    """, fetch="all"
+    """, fetch="all", read=True, guild_id=guild_id
     )
 
     return res